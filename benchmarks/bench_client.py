@@ -0,0 +1,297 @@
+"""
+Measures the client's hot path against an in-process mock server: requests
+per second and CPU time per call, per endpoint, payload size and
+concurrency mode. Separately, per endpoint and payload size, it measures
+the peak memory of a call and the time spent encoding and decoding JSON
+(with a request observer, which takes a slower path), against a mock
+server in another process so that only the client is measured.
+
+    $ python benchmarks/bench_client.py --output results.json
+    $ python benchmarks/bench_client.py --sizes 10,1000 --modes single --compare results.json
+
+With `--compare`, exits with status 1 when requests/sec dropped, or CPU per
+call grew, by more than `--threshold` compared to an earlier run.
+
+Requires Python 3.5+; the async mode also requires aiohttp.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import yesgraph  # noqa: E402
+from yesgraph import YesGraphAPI  # noqa: E402
+from yesgraph_mock import MockServer, make_contacts  # noqa: E402
+
+try:
+    from yesgraph_async import AsyncYesGraphAPI
+except ImportError:  # pragma: no cover
+    AsyncYesGraphAPI = None
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def make_calls(size):
+    """Returns `{endpoint: function(api)}` for payloads (or responses) of `size` entries."""
+    contacts = make_contacts(size)
+    invites = [{'user_id': '1', 'email': c['emails'][0], 'sent_at': '2016-01-01T00:00:00'} for c in contacts]
+    seen = [{'user_id': '1', 'emails': c['emails'], 'seen_at': '2016-01-01T00:00:00'} for c in contacts]
+    users = [{'user_id': str(i), 'name': c['name'], 'email': c['emails'][0]} for i, c in enumerate(contacts)]
+    return {
+        'POST /address-book': lambda api: api.post_address_book('1', contacts, 'gmail'),
+        'GET /address-book': lambda api: api.get_address_book('1', limit=size),
+        'POST /invites-sent': lambda api: api.post_invites_sent(entries=invites),
+        'POST /suggested-seen': lambda api: api.post_suggested_seen(entries=seen),
+        'POST /users': lambda api: api.post_users(users),
+    }
+
+
+class Phases(object):
+    """Observer summing up the encode and decode time of all requests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {'encode': 0.0, 'decode': 0.0}
+
+    def __call__(self, trace):
+        with self.lock:
+            for phase in self.totals:
+                self.totals[phase] += trace.timings.get(phase, 0.0)
+
+
+def run_single(base_url, call, calls):
+    api = YesGraphAPI('secret', base_url=base_url)
+    call(api)  # warm up the connection
+
+    started, cpu = time.perf_counter(), thread_time()
+    for _ in range(calls):
+        call(api)
+    return time.perf_counter() - started, thread_time() - cpu
+
+
+def run_threaded(base_url, call, calls, concurrency):
+    api = YesGraphAPI('secret', base_url=base_url, pool_maxsize=concurrency)
+    call(api)
+
+    def work(n):
+        cpu = thread_time()
+        for _ in range(n):
+            call(api)
+        return thread_time() - cpu
+
+    shares = [calls // concurrency + (1 if i < calls % concurrency else 0) for i in range(concurrency)]
+    pool = ThreadPool(concurrency)
+    try:
+        started = time.perf_counter()
+        cpu = sum(pool.map(work, shares))
+        return time.perf_counter() - started, cpu
+    finally:
+        pool.terminate()
+
+
+def run_async(base_url, call, calls, concurrency):
+    async def scenario():
+        async with AsyncYesGraphAPI('secret', base_url=base_url, limit=concurrency) as api:
+            await call(api)
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def one():
+                async with semaphore:
+                    await call(api)
+
+            started, cpu = time.perf_counter(), thread_time()
+            await asyncio.gather(*[one() for _ in range(calls)])
+            return time.perf_counter() - started, thread_time() - cpu
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+
+class MockServerProcess(object):
+    """Runs `python -m yesgraph_mock` on a free port until stopped."""
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, '-u', '-m', 'yesgraph_mock', '--port', '0', '--no-store'],
+                                        cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('The mock server did not start')
+        self.base_url = line.split()[-1]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def measure_phases(base_url, call, calls):
+    """Returns the mean time spent encoding and decoding JSON per call, in ms, as seen by an observer."""
+    phases = Phases()
+    api = YesGraphAPI('secret', base_url=base_url, observers=[phases])
+    call(api)
+    phases.totals = dict.fromkeys(phases.totals, 0.0)
+    for _ in range(calls):
+        call(api)
+    return dict((phase, total / calls * 1000) for phase, total in phases.totals.items())
+
+
+def measure_memory(base_url, call, calls=3):
+    """
+    Returns the mean peak of memory allocated during a call, in KiB. The
+    server at `base_url` must run in another process, or its allocations
+    are counted too.
+    """
+    api = YesGraphAPI('secret', base_url=base_url)
+    call(api)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            baseline = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            call(api)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks) / 1024.0
+
+
+def run(sizes, modes, endpoints, concurrency, budget, max_calls):
+    """
+    Returns `(results, profiles)`: the throughput of every endpoint, size
+    and mode, and the JSON phases and memory of every endpoint and size.
+    """
+    server = MockServer(store=False).start()
+    profile_server = MockServerProcess()
+    results, profiles = [], []
+    try:
+        for size in sizes:
+            for endpoint, call in sorted(make_calls(size).items()):
+                if endpoints and endpoint not in endpoints:
+                    continue
+                calls = max(3, min(max_calls, budget // size))
+
+                phases = measure_phases(profile_server.base_url, call, max(3, calls // 10))
+                profile = {
+                    'endpoint': endpoint,
+                    'entries': size,
+                    'encode_ms_per_call': phases['encode'],
+                    'decode_ms_per_call': phases['decode'],
+                    'peak_kib_per_call': measure_memory(profile_server.base_url, call),
+                }
+                profiles.append(profile)
+                print('{endpoint:<22} {entries:>7} {encode_ms_per_call:>8.3f} ms enc '
+                      '{decode_ms_per_call:>8.3f} ms dec {peak_kib_per_call:>10.1f} KiB'.format(**profile),
+                      file=sys.stderr)
+
+                for mode in modes:
+                    if mode == 'single':
+                        seconds, cpu = run_single(server.base_url, call, calls)
+                    elif mode == 'threaded':
+                        seconds, cpu = run_threaded(server.base_url, call, calls, concurrency)
+                    else:
+                        seconds, cpu = run_async(server.base_url, call, calls, concurrency)
+                    result = {
+                        'endpoint': endpoint,
+                        'entries': size,
+                        'mode': mode,
+                        'calls': calls,
+                        'requests_per_second': calls / seconds,
+                        'cpu_ms_per_call': cpu / calls * 1000,
+                    }
+                    results.append(result)
+                    print('{endpoint:<22} {entries:>7} {mode:<9} {requests_per_second:>9.1f} req/s '
+                          '{cpu_ms_per_call:>9.3f} ms cpu'.format(**result), file=sys.stderr)
+    finally:
+        server.stop()
+        profile_server.stop()
+    return results, profiles
+
+
+def compare(results, baseline, threshold):
+    """Returns a description of every result that regressed against `baseline`."""
+    def key(result):
+        return result['endpoint'], result['entries'], result['mode']
+
+    before = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        if result['requests_per_second'] < old['requests_per_second'] * (1 - threshold):
+            regressions.append('{0} {1} {2}: {3:.1f} req/s, was {4:.1f}'.format(
+                *key(result) + (result['requests_per_second'], old['requests_per_second'])))
+        if result['cpu_ms_per_call'] > old['cpu_ms_per_call'] * (1 + threshold):
+            regressions.append('{0} {1} {2}: {3:.3f} ms cpu per call, was {4:.3f}'.format(
+                *key(result) + (result['cpu_ms_per_call'], old['cpu_ms_per_call'])))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma separated numbers of entries per request')
+    parser.add_argument('--modes', default='single,threaded,async')
+    parser.add_argument('--endpoints', default='', help='comma separated, e.g. "POST /users", default all')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads or tasks in the concurrent modes')
+    parser.add_argument('--budget', type=int, default=500000, help='entries to send per endpoint, size and mode')
+    parser.add_argument('--max-calls', type=int, default=500)
+    parser.add_argument('--output', help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    if 'async' in modes and AsyncYesGraphAPI is None:
+        print('aiohttp is not installed, skipping the async mode', file=sys.stderr)
+        modes.remove('async')
+
+    results, profiles = run([int(size) for size in args.sizes.split(',')], modes,
+                            [e for e in args.endpoints.split(',') if e], args.concurrency, args.budget,
+                            args.max_calls)
+    report = {
+        'meta': {
+            'yesgraph': yesgraph.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'codec': yesgraph.default_codec.name,
+            'concurrency': args.concurrency,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+        'profiles': profiles,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Compares the JSON codecs on payloads shaped like the ones sent to, and
+received from, each endpoint, and the address book entry formats (dicts,
+`Contact` records and an `AddressBookBatch`) on the body of
+`post_address_book()`.
+
+    $ python benchmarks/bench_codec.py [--entries 5000] [--repeat 5] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from yesgraph import CODECS, AddressBookBatch, Contact, iter_json_body  # noqa: E402
+
+
+def make_payloads(n):
+    contacts = [{
+        'name': u'Contact {0} J\xfcrgensen'.format(i),
+        'emails': ['contact{0}@example.org'.format(i), 'c{0}@work.example.com'.format(i)],
+        'phones': ['+1 415 555 {0:04d}'.format(i % 10000)],
+    } for i in range(n)]
+    return {
+        'POST /address-book': {'user_id': '1', 'source': {'type': 'gmail'}, 'filter_suggested_seen': 30,
+                               'entries': contacts},
+        'POST /invites-sent': {'entries': [{'user_id': '1', 'email': c['emails'][0],
+                                            'sent_at': '2016-01-01T00:00:00'} for c in contacts]},
+        'POST /suggested-seen': {'entries': [{'user_id': '1', 'emails': c['emails'],
+                                              'seen_at': '2016-01-01T00:00:00'} for c in contacts]},
+        'POST /users': [{'user_id': str(i), 'name': c['name'], 'email': c['emails'][0]}
+                        for i, c in enumerate(contacts)],
+        'GET /address-book': {'meta': {'total': n},
+                              'data': [dict(c, rank=i, score=1.0 / (i + 1)) for i, c in enumerate(contacts)]},
+    }
+
+
+def available_codecs():
+    for codec_class in CODECS:
+        try:
+            yield codec_class()
+        except ImportError:
+            pass
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(entries, repeat):
+    results = []
+    for endpoint, payload in sorted(make_payloads(entries).items()):
+        data = json.dumps(payload).encode('utf-8')
+        for codec in available_codecs():
+            results.append({
+                'endpoint': endpoint,
+                'codec': codec.name,
+                'bytes': len(data),
+                'dumps_ms': best_of(lambda: codec.dumps(payload), repeat) * 1000,
+                'loads_ms': best_of(lambda: codec.loads(data), repeat) * 1000,
+            })
+    return results
+
+
+def run_formats(entries, repeat):
+    """Times encoding the `post_address_book()` body the way the client does for each format of entries."""
+    payload = make_payloads(entries)['POST /address-book']
+    contacts = [Contact(**c) for c in payload['entries']]
+    formats = [('dicts', payload['entries']), ('contacts', contacts),
+               ('batch', AddressBookBatch.from_contacts(contacts))]
+    results = []
+    for codec in available_codecs():
+        for name, items in formats:
+            doc = dict(payload, entries=items)
+            if name == 'dicts':
+                encode = lambda: codec.dumps(doc)  # noqa: E731
+            else:
+                encode = lambda: b''.join(iter_json_body(doc, 'entries', items, codec=codec))  # noqa: E731
+            results.append({'format': name, 'codec': codec.name, 'bytes': len(encode()),
+                            'dumps_ms': best_of(encode, repeat) * 1000})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.entries, args.repeat)
+    formats = run_formats(args.entries, args.repeat)
+    if args.json:
+        print(json.dumps({'endpoints': results, 'formats': formats}, indent=2))
+        return
+
+    baseline = dict(((r['endpoint'], 'dumps'), r['dumps_ms']) for r in results if r['codec'] == 'json')
+    baseline.update(((r['endpoint'], 'loads'), r['loads_ms']) for r in results if r['codec'] == 'json')
+    print('{0:<22} {1:<10} {2:>10} {3:>16} {4:>16}'.format('endpoint', 'codec', 'bytes', 'dumps ms', 'loads ms'))
+    for r in results:
+        print('{0:<22} {1:<10} {2:>10} {3:>9.2f} ({4:>4.1f}x) {5:>9.2f} ({6:>4.1f}x)'.format(
+            r['endpoint'], r['codec'], r['bytes'],
+            r['dumps_ms'], baseline[r['endpoint'], 'dumps'] / r['dumps_ms'],
+            r['loads_ms'], baseline[r['endpoint'], 'loads'] / r['loads_ms']))
+
+    baseline = dict((r['codec'], r['dumps_ms']) for r in formats if r['format'] == 'dicts')
+    print()
+    print('{0:<22} {1:<10} {2:>10} {3:>16}'.format('address book format', 'codec', 'bytes', 'dumps ms'))
+    for r in formats:
+        print('{0:<22} {1:<10} {2:>10} {3:>9.2f} ({4:>4.1f}x)'.format(
+            r['format'], r['codec'], r['bytes'], r['dumps_ms'], baseline[r['codec']] / r['dumps_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures the cold start of short-lived workers: importing yesgraph, creating
+a client and sending a single request to the mock server, each in a fresh
+interpreter.
+
+    $ python benchmarks/bench_import.py [--runs 20] [--importtime] [--json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+# Let the first run write bytecode, as it would be on an installed package
+ENV = dict((k, v) for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE')
+
+from yesgraph_mock import MockServer  # noqa: E402
+
+SCENARIOS = [
+    ('import', ''),
+    ('import + client', "api = yesgraph.YesGraphAPI('secret', base_url=base_url)"),
+    ('import + client + post', "api = yesgraph.YesGraphAPI('secret', base_url=base_url)\n"
+                               "api.post_invites_sent(entries=[{'user_id': '1', 'email': 'a@example.org'}])"),
+]
+
+TEMPLATE = """
+import sys, time
+started = time.perf_counter()
+import yesgraph
+base_url = sys.argv[1]
+{0}
+print(time.perf_counter() - started)
+"""
+
+
+def run(code, base_url, runs):
+    """Returns the times it took to run `code` in `runs` new interpreters, in ms."""
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', TEMPLATE.format(code), base_url],
+                                         cwd=ROOT, env=ENV)
+        times.append(float(output) * 1000)
+    return sorted(times)
+
+
+def importtime():
+    """Prints the time it takes to import yesgraph and its imports, as reported by `-X importtime`."""
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import yesgraph'],
+                                     cwd=ROOT, env=ENV, stderr=subprocess.STDOUT).decode('utf-8')
+    rows = []
+    for line in output.splitlines()[1:]:
+        _, own, cumulative, name = line.replace(':', '|', 1).split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if name == 'yesgraph':
+            print('{0:>10} us {1:>10} us  {2}'.format(cumulative.strip(), own.strip(), name), file=sys.stderr)
+            rows.sort(reverse=True)
+            for row in rows[:15]:
+                print('{0:>10} us {1:>10} us    {2}'.format(*row), file=sys.stderr)
+            return
+        if depth == 1:  # imported by yesgraph (imports print before their importer)
+            rows.append((int(cumulative), int(own), name))
+        elif depth == 0:
+            rows = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--importtime', action='store_true', help='print the slowest imports of `import yesgraph`')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = []
+    with MockServer(store=False) as server:
+        run('', server.base_url, 1)  # compile the modules
+        if args.importtime:
+            importtime()
+        for name, code in SCENARIOS:
+            times = run(code, server.base_url, args.runs)
+            results.append({'scenario': name, 'runs': args.runs, 'min_ms': times[0],
+                            'median_ms': times[len(times) // 2]})
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print('{scenario:<24} {median_ms:>8.1f} ms median {min_ms:>8.1f} ms min'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
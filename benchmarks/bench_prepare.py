@@ -0,0 +1,108 @@
+"""
+Compares the per-call CPU overhead of preparing requests through
+`Session.prepare_request()` with the client's precomputed fast path, on its
+own and for complete small requests against the mock server.
+
+    $ python benchmarks/bench_prepare.py [--calls 20000] [--profile] [--json]
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from yesgraph import YesGraphAPI  # noqa: E402
+from yesgraph_mock import MockServer  # noqa: E402
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+REQUESTS = {
+    'GET /address-book': ('GET', '/address-book/1234', None, {'limit': 20, 'filter_blank_names': True}),
+    'POST /invites-sent': ('POST', '/invites-sent', b'{"entries":[{"user_id":"1","email":"a@example.org"}]}', {}),
+}
+
+
+def paths(api):
+    """Returns the slow and the fast way to prepare requests with `api`."""
+    def session(method, endpoint, data, args):
+        return api._prepare_with_session(api.session, method, endpoint, data, **args)
+
+    def fast(method, endpoint, data, args):
+        return api._prepare_fast(method, endpoint, data, **args)
+
+    return {'session': session, 'fast': fast}
+
+
+def bench_prepare(calls):
+    api = YesGraphAPI('secret')
+    results = []
+    for name, request in sorted(REQUESTS.items()):
+        for path, prepare in sorted(paths(api).items()):
+            seconds = min(timeit.repeat(lambda: prepare(*request), number=calls, repeat=3))
+            results.append({'benchmark': 'prepare', 'request': name, 'path': path,
+                            'us_per_call': seconds / calls * 1e6})
+    return results
+
+
+def bench_round_trip(calls):
+    results = []
+    with MockServer(store=False) as server:
+        for name, (method, endpoint, data, args) in sorted(REQUESTS.items()):
+            for path in ('session', 'fast'):
+                api = YesGraphAPI('secret', base_url=server.base_url)
+                prepare = paths(api)[path]
+
+                def prepare_request(method, endpoint, data=None, **args):
+                    return prepare(method, endpoint, data, args)
+
+                api._prepare_request = prepare_request
+                api._request(method, endpoint, data, **args)  # connect
+                started, cpu = time.perf_counter(), thread_time()
+                for _ in range(calls):
+                    api._request(method, endpoint, data, **args)
+                results.append({'benchmark': 'round trip', 'request': name, 'path': path,
+                                'us_per_call': (thread_time() - cpu) / calls * 1e6,
+                                'requests_per_second': calls / (time.perf_counter() - started)})
+    return results
+
+
+def profile(calls):
+    api = YesGraphAPI('secret')
+    method, endpoint, data, args = REQUESTS['POST /invites-sent']
+    for path, prepare in sorted(paths(api).items()):
+        print('--- {0} ---'.format(path), file=sys.stderr)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for _ in range(calls):
+            prepare(method, endpoint, data, args)
+        profiler.disable()
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(12)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--round-trips', type=int, default=1000)
+    parser.add_argument('--profile', action='store_true', help='print cProfile statistics of both paths')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    if args.profile:
+        profile(args.calls)
+
+    results = bench_prepare(args.calls) + bench_round_trip(args.round_trips)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print('{benchmark:<12} {request:<20} {path:<8} {us_per_call:>9.1f} us cpu'.format(**r)
+              + ('  {0:>8.1f} req/s'.format(r['requests_per_second']) if 'requests_per_second' in r else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,18 @@
 Python wrapper for the YesGraph API.
 """
 import re
+import sys
 
 from setuptools import setup
 
 dependencies = ['requests', 'six']
 
+# yesgraph_async uses async/await and is only installed on Python 3.5+, so
+# wheels are built per Python version rather than as one universal wheel.
+modules = ['yesgraph', 'yesgraph_mock']
+if sys.version_info >= (3, 5):
+    modules.append('yesgraph_async')
+
 # Change the version number in yesgraph.py, not here.
 version = ''
 with open('yesgraph.py', 'r') as f:
@@ -21,17 +28,21 @@ setup(
     author_email='team@yesgraph.com',
     description='Python wrapper for the YesGraph API.',
     long_description=__doc__,
-    py_modules=['yesgraph'],
+    py_modules=modules,
     include_package_data=True,
     zip_safe=False,
     platforms='any',
     install_requires=dependencies,
+    extras_require={
+        'async:python_version>="3.5"': ['aiohttp'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
         'Topic :: Software Development',
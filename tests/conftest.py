@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # The asyncio client uses async/await syntax
+    collect_ignore.append('test_yesgraph_async.py')
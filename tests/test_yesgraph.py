@@ -1,10 +1,24 @@
+import gc
 import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import weakref
+import zlib
 from datetime import datetime
 
-from requests import HTTPError
+from requests import ConnectionError, ConnectTimeout, HTTPError, ReadTimeout, Session
+from six.moves import queue
 
 import pytest
-from yesgraph import YesGraphAPI
+from yesgraph import (CODECS, DEFAULT_TIMEOUT, AddressBookBatch, BloomFilter, ChunkedResult, Contact, Deadline,
+                      FileTokenBucket, Histogram, InviteEvent, JSONArrayParser, JSONCodec, LatencyHistograms,
+                      LazyModule, RateLimiter, RetryPolicy, RotatingBloomFilter, SingleFlight, SQLiteCache, Timeouts,
+                      TokenBucket, TTLCache, YesGraphAPI, YesGraphEventBuffer, YesGraphOutbox, YesGraphTimeout,
+                      default_codec, get_codec, imap_unordered, iter_chunks, iter_json_body, normalize_contacts,
+                      normalize_phone, parse_retry_after)
 
 from .helpers import make_fake_response
 
@@ -96,7 +110,7 @@ def test_endpoint_get_client_key(api):
     req = api._get_client_key(user_id=1234)
     assert req.method == 'POST'
     assert req.url == 'https://api.yesgraph.com/v0/client-key'
-    assert req.body == '{"user_id": "1234"}'
+    assert json.loads(req.body) == {'user_id': '1234'}
 
 
 def test_endpoint_get_address_book(api):
@@ -429,3 +443,1315 @@ def test_response_with_error(api):
 
     with pytest.raises(HTTPError):
         api._handle_response(fake_http_response)
+
+
+@pytest.mark.parametrize('codec', [JSONCodec(), default_codec])
+def test_codec_round_trip(codec):
+    doc = {'entries': [{'name': u'J\xfcrgen', 'email': 'j@example.org', 'seen_at': None, 'score': 1.5}]}
+    data = codec.dumps(doc)
+    assert isinstance(data, bytes)
+    assert json.loads(data.decode('utf-8')) == doc
+    assert codec.loads(data) == doc
+
+
+def installed_codecs():
+    for codec_class in CODECS:
+        try:
+            yield codec_class()
+        except ImportError:
+            pass
+
+
+@pytest.mark.parametrize('codec', list(installed_codecs()), ids=lambda codec: codec.name)
+def test_codec_rejects_what_json_rejects(codec):
+    values = [datetime(2015, 3, 28, 20, 16, 12), datetime(2015, 3, 28).date(), object()]
+    try:
+        import dataclasses
+        values.append(dataclasses.make_dataclass('Event', ['user_id'])('1'))
+    except ImportError:  # before Python 3.7
+        pass
+    for value in values:
+        with pytest.raises(TypeError):
+            codec.dumps({'entries': [{'user_id': '1', 'created_at': value}]})
+
+    api = RecordingYesGraphAPI(secret_key='foo', codec=codec)
+    with pytest.raises(TypeError):
+        api.post_users([{'user_id': '1', 'created_at': datetime(2015, 3, 28)}])
+    assert api.sent == []
+
+
+def test_get_codec():
+    assert isinstance(get_codec('json'), JSONCodec)
+    assert get_codec().name == default_codec.name
+    with pytest.raises(ValueError):
+        get_codec('yaml')
+
+
+def test_api_codec():
+    assert YesGraphAPI(secret_key='foo').codec is default_codec
+    api = YesGraphAPI(secret_key='foo', codec='json')
+    assert api.codec.name == 'json'
+    response = make_fake_response(200, {'data': [1, 2]})
+    assert api._handle_response(response) == {'data': [1, 2]}
+
+
+def test_iter_chunks():
+    entries = [{'email': 'user{0}@example.org'.format(i)} for i in range(10)]
+
+    # by count
+    chunks = list(iter_chunks(entries, chunk_size=4))
+    assert [index for index, _, _ in chunks] == [0, 1, 2]
+    assert [len(chunk) for _, chunk, _ in chunks] == [4, 4, 2]
+    for _, chunk, body in chunks:
+        assert json.loads(body) == {'entries': chunk}
+
+    # by serialized size
+    chunks = list(iter_chunks(entries, max_chunk_bytes=100))
+    assert sum(len(chunk) for _, chunk, _ in chunks) == 10
+    for _, chunk, body in chunks:
+        assert len(body) <= 100
+        assert json.loads(body) == {'entries': chunk}
+
+    # other keys of the document go into every chunk
+    chunks = list(iter_chunks(entries, chunk_size=4, doc={'source': 'import', 'entries': None}))
+    assert [json.loads(body) for _, _, body in chunks] == [
+        {'source': 'import', 'entries': entries[0:4]}, {'source': 'import', 'entries': entries[4:8]},
+        {'source': 'import', 'entries': entries[8:]}]
+
+    # bare lists and oversized entries
+    chunks = list(iter_chunks(['x' * 50, 'y'], key=None, max_chunk_bytes=10))
+    assert [json.loads(body) for _, _, body in chunks] == [['x' * 50], ['y']]
+
+    with pytest.raises(ValueError):
+        list(iter_chunks(entries, chunk_size=0))
+
+
+class FlakyYesGraphAPI(SafeYesGraphAPI):
+    """Fails every request whose body mentions a "bad" entry."""
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        if data and b'bad' in data:
+            raise HTTPError('500 Server Error')
+        return {'endpoint': endpoint, 'entries': json.loads(data)['entries']}
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_chunked_batch_endpoints(concurrency):
+    api = FlakyYesGraphAPI(secret_key='foo')
+    entries = [{'user_id': str(i), 'email': 'user{0}@example.org'.format(i)} for i in range(25)]
+    entries[12]['email'] = 'bad@example.org'
+
+    result = api.post_invites_sent(entries=entries, chunk_size=5, concurrency=concurrency)
+
+    assert isinstance(result, ChunkedResult)
+    assert not result.ok
+    assert [outcome.index for outcome in result.succeeded] == [0, 1, 3, 4]
+    assert [outcome.index for outcome in result.failed] == [2]
+    assert result.failed_entries() == entries[10:15]
+    assert isinstance(result.failed[0].error, HTTPError)
+    assert sum(len(r['entries']) for r in result.results) == 20
+
+    with pytest.raises(HTTPError):
+        result.raise_for_errors()
+
+    for method, kwargs, endpoint in [
+        (api.post_invites_accepted, {'entries': entries[:10]}, '/invites-accepted'),
+        (api.post_suggested_seen, {'entries': entries[:10]}, '/suggested-seen'),
+        (api.post_users, {'users': {'entries': entries[:10]}}, '/users'),
+    ]:
+        result = method(chunk_size=3, concurrency=concurrency, **kwargs)
+        assert result.ok
+        assert [outcome.size for outcome in result.succeeded] == [3, 3, 3, 1]
+        assert set(r['endpoint'] for r in result.results) == {endpoint}
+
+
+def test_chunked_post_users(api):
+    users = {'source': 'import', 'entries': [{'user_id': str(i)} for i in range(5)]}
+    result = api.post_users(users, chunk_size=2)
+    assert [json.loads(outcome.result.body) for outcome in result.succeeded] == [
+        {'source': 'import', 'entries': users['entries'][0:2]},
+        {'source': 'import', 'entries': users['entries'][2:4]},
+        {'source': 'import', 'entries': users['entries'][4:]},
+    ]
+
+
+def test_chunked_post_alias(api):
+    emails = ['user{0}@example.org'.format(i) for i in range(5)]
+    result = api.post_alias(emails=emails, chunk_size=2)
+    assert [json.loads(outcome.result.body) for outcome in result.succeeded] == [
+        {'emails': emails[0:2]}, {'emails': emails[2:4]}, {'emails': emails[4:]},
+    ]
+
+
+def test_imap_unordered():
+    assert sorted(imap_unordered(lambda x: x * 2, range(100), 8)) == [x * 2 for x in range(100)]
+
+    def explode(x):
+        raise KeyError(x)
+
+    with pytest.raises(KeyError):
+        list(imap_unordered(explode, range(10), 2))
+
+
+class RecordingYesGraphAPI(SafeYesGraphAPI):
+    """Records the decoded body of every request instead of sending it."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingYesGraphAPI, self).__init__(*args, **kwargs)
+        self.sent = []
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        self.sent.append((endpoint, json.loads(data)))
+        return {}
+
+
+def test_event_buffer_batches_events():
+    api = RecordingYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, max_batch_size=3, flush_interval=60)
+
+    now = datetime(2015, 3, 19, 13, 37, 0)
+    for i in range(7):
+        buf.add_invite_sent({'user_id': str(i), 'email': 'a@example.org', 'sent_at': now})
+    buf.add_suggested_seen({'user_id': '1', 'emails': ['b@example.org']})
+    buf.add_invite_accepted({'email': 'c@example.org'})
+    buf.close()
+
+    assert len(buf) == 0
+    sent = [e for endpoint, body in api.sent if endpoint == '/invites-sent' for e in body['entries']]
+    assert [e['user_id'] for e in sent] == [str(i) for i in range(7)]
+    assert all(e['sent_at'] == '2015-03-19T13:37:00' for e in sent)
+    assert all(len(body['entries']) <= 3 for _, body in api.sent)
+    assert ('/suggested-seen', {'entries': [{'user_id': '1', 'emails': ['b@example.org']}]}) in api.sent
+    assert ('/invites-accepted', {'entries': [{'email': 'c@example.org'}]}) in api.sent
+
+    with pytest.raises(ValueError):
+        buf.add_invite_sent({'user_id': '1'})
+
+
+def test_event_buffer_accepts_records():
+    api = RecordingYesGraphAPI(secret_key='foo')
+    with YesGraphEventBuffer(api, flush_interval=60) as buf:
+        buf.add_invite_sent(InviteEvent(1, email='a@example.org', sent_at=datetime(2015, 3, 19, 13, 37, 0)))
+    assert api.sent == [('/invites-sent', {'entries': [
+        {'user_id': '1', 'email': 'a@example.org', 'sent_at': '2015-03-19T13:37:00'}]})]
+
+
+def test_event_buffer_close_race():
+    api = RecordingYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, flush_interval=60)
+    put = buf._queue.put
+
+    def put_after_close(*args):
+        buf.close()  # close() wins the race right after add() checked for it
+        put(*args)
+
+    buf._queue.put = put_after_close
+    buf.add_invite_sent({'user_id': '1', 'email': 'a@example.org'})
+    assert api.sent == [('/invites-sent', {'entries': [{'user_id': '1', 'email': 'a@example.org'}]})]
+
+
+def test_event_buffer_collected_after_close():
+    buf = YesGraphEventBuffer(RecordingYesGraphAPI(secret_key='foo'), flush_interval=60)
+    buf.close()
+    ref = weakref.ref(buf)
+    del buf
+    gc.collect()
+    assert ref() is None
+
+
+def test_event_buffer_flushes_on_interval():
+    api = RecordingYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, max_batch_size=100, flush_interval=0.01)
+    buf.add_invite_sent({'user_id': '1', 'email': 'a@example.org'})
+
+    for _ in range(500):
+        if api.sent:
+            break
+        time.sleep(0.01)
+    assert api.sent == [('/invites-sent', {'entries': [{'user_id': '1', 'email': 'a@example.org'}]})]
+    buf.close()
+
+
+def test_event_buffer_backpressure():
+    api = RecordingYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, max_batch_size=100, flush_interval=60, max_size=2)
+    buf._send_lock.acquire()  # stall the background thread
+    try:
+        buf.add_invite_sent({'user_id': '1'})
+        buf.add_invite_sent({'user_id': '2'})
+        with pytest.raises(queue.Full):
+            buf.add_invite_sent({'user_id': '3'}, block=False)
+        with pytest.raises(queue.Full):
+            buf.add_invite_sent({'user_id': '3'}, timeout=0.01)
+    finally:
+        buf._send_lock.release()
+    buf.close()
+    assert api.sent == [('/invites-sent', {'entries': [{'user_id': '1'}, {'user_id': '2'}]})]
+
+
+def test_event_buffer_reports_errors():
+    errors = []
+    api = FlakyYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, flush_interval=60,
+                              on_error=lambda error, endpoint, entries: errors.append((endpoint, entries)))
+    buf.add_suggested_seen({'user_id': 'bad'})
+    buf.flush()
+    assert errors == [('/suggested-seen', [{'user_id': 'bad'}])]
+    buf.close()
+
+
+def test_event_buffer_survives_unexpected_errors():
+    class BrokenYesGraphAPI(RecordingYesGraphAPI):
+        def _request(self, method, endpoint, data=None, **url_args):
+            if b'bad' in data:
+                raise ValueError('not JSON')
+            return super(BrokenYesGraphAPI, self)._request(method, endpoint, data, **url_args)
+
+    def on_error(error, endpoint, entries):
+        raise RuntimeError('handler bug')
+
+    api = BrokenYesGraphAPI(secret_key='foo')
+    buf = YesGraphEventBuffer(api, max_batch_size=1, flush_interval=0.01, max_size=1, on_error=on_error)
+    buf.add_invite_sent({'user_id': 'bad'})
+    buf.add_invite_sent({'user_id': '1'}, timeout=5)  # would block forever with a dead thread
+    for _ in range(500):
+        if api.sent:
+            break
+        time.sleep(0.01)
+    assert buf._thread.is_alive()
+    buf.close()
+    assert api.sent == [('/invites-sent', {'entries': [{'user_id': '1'}]})]
+
+
+def test_outbox_replays_pending_events(tmpdir):
+    path = str(tmpdir.join('outbox.db'))
+    entries = [{'user_id': str(i), 'email': 'user{0}@example.org'.format(i)} for i in range(5)]
+
+    outbox = YesGraphOutbox(RecordingYesGraphAPI(secret_key='foo'), path, batch_size=2)
+    outbox.add_invites_sent(entries)
+    outbox.add_invites_sent(entries[:2])  # duplicates are only stored once
+    outbox.add_suggested_seen([{'user_id': '1', 'emails': ['a@example.org']}])
+    assert len(outbox) == 6
+    outbox.close()  # "crash" before anything was sent
+
+    api = RecordingYesGraphAPI(secret_key='foo')
+    with YesGraphOutbox(api, path, batch_size=2) as outbox:
+        assert len(outbox) == 6
+        assert outbox.flush() == 6
+        assert len(outbox) == 0
+        assert outbox.flush() == 0
+
+    assert [endpoint for endpoint, _ in api.sent] == ['/invites-sent'] * 3 + ['/suggested-seen']
+    assert [e for _, body in api.sent[:3] for e in body['entries']] == entries
+
+
+def test_outbox_accepts_dates_and_records(tmpdir):
+    api = RecordingYesGraphAPI(secret_key='foo')
+    with YesGraphOutbox(api, str(tmpdir.join('outbox.db'))) as outbox:
+        outbox.add_invites_sent([{'user_id': '1', 'email': 'a@example.org', 'sent_at': datetime(2015, 3, 28, 20, 16)},
+                                 InviteEvent('2', email='b@example.org', sent_at=datetime(2015, 3, 28))])
+        outbox.add_invites_sent([{'user_id': '1', 'email': 'a@example.org', 'sent_at': '2015-03-28T20:16:00'}])
+        outbox.add_suggested_seen([{'user_id': '1', 'emails': ['a@example.org'], 'seen_at': datetime(2015, 3, 28)}])
+        assert len(outbox) == 3  # the formatted date makes the same event
+        outbox.flush()
+
+    assert sorted(api.sent) == [
+        ('/invites-sent', {'entries': [
+            {'user_id': '1', 'email': 'a@example.org', 'sent_at': '2015-03-28T20:16:00'},
+            {'user_id': '2', 'email': 'b@example.org', 'sent_at': '2015-03-28T00:00:00'},
+        ]}),
+        ('/suggested-seen', {'entries': [{'user_id': '1', 'emails': ['a@example.org'],
+                                          'seen_at': '2015-03-28T00:00:00'}]}),
+    ]
+
+
+def test_outbox_keeps_undelivered_events(tmpdir):
+    path = str(tmpdir.join('outbox.db'))
+    entries = [{'user_id': 'good'}, {'user_id': 'bad'}, {'user_id': 'good too'}]
+
+    with YesGraphOutbox(FlakyYesGraphAPI(secret_key='foo'), path, batch_size=1) as outbox:
+        outbox.add_invites_accepted(entries)
+        with pytest.raises(HTTPError):
+            outbox.flush()
+        assert len(outbox) == 2
+
+    api = RecordingYesGraphAPI(secret_key='foo')
+    with YesGraphOutbox(api, path) as outbox:
+        outbox.flush()
+    assert api.sent == [('/invites-accepted', {'entries': entries[1:]})]
+
+    with pytest.raises(ValueError):
+        outbox.add('/users', entries)
+
+
+class FakeSession(Session):
+    """Session that answers with canned responses (or raises canned errors)."""
+
+    def __init__(self, *responses):
+        super(FakeSession, self).__init__()
+        self.responses = list(responses)
+        self.sent = []
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        self.timeouts.append(kwargs.get('timeout'))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_retry_after_response(status, retry_after):
+    response = make_fake_response(status, {'error': 'slow down'})
+    response.headers['Retry-After'] = retry_after
+    return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_retry_policy_is_retryable():
+    policy = RetryPolicy()
+
+    assert policy.is_retryable('GET', status=502)
+    assert policy.is_retryable('DELETE', status=500)
+    assert not policy.is_retryable('GET', status=404)
+    assert policy.is_retryable('GET')  # e.g. a read timeout
+
+    # POSTs only when the server certainly didn't process them
+    assert policy.is_retryable('POST', status=429)
+    assert policy.is_retryable('POST', status=503)
+    assert policy.is_retryable('POST', connect_error=True)
+    assert not policy.is_retryable('POST', status=502)
+    assert not policy.is_retryable('POST')
+
+    assert RetryPolicy(retry_post=True).is_retryable('POST', status=502)
+
+
+def test_retry_policy_delays():
+    policy = RetryPolicy(max_retries=3, backoff_base=0.1, backoff_cap=2.0, deadline=5.0)
+
+    delay = None
+    for _ in range(100):
+        delay = policy.backoff(delay)
+        assert 0.1 <= delay <= 2.0
+
+    assert policy.get_delay('GET', 0, 0, status=502) <= 0.3
+    assert policy.get_delay('GET', 3, 0, status=502) is None  # out of retries
+    assert policy.get_delay('GET', 0, 0, status=400) is None
+    assert policy.get_delay('GET', 0, 0, status=429, headers={'Retry-After': '3'}) == 3.0
+    assert policy.get_delay('GET', 0, 3, status=429, headers={'Retry-After': '3'}) is None  # past the deadline
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0  # in the past
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+
+def test_request_retries(sleeps):
+    api = YesGraphAPI(secret_key='foo', retry=RetryPolicy(max_retries=3))
+    api.session = FakeSession(
+        ConnectionError('connection reset'),
+        make_fake_response(502, {'error': 'bad gateway'}),
+        make_retry_after_response(429, '7'),
+        make_fake_response(200, {'data': []}),
+    )
+
+    assert api.get_address_book(user_id=1) == {'data': []}
+    assert len(api.session.sent) == 4
+    assert len(sleeps) == 3
+    assert sleeps[2] == 7.0
+
+
+def test_request_observers(sleeps):
+    traces = []
+    histograms = LatencyHistograms()
+    api = YesGraphAPI(secret_key='foo', retry=RetryPolicy(max_retries=3), observers=[traces.append, histograms])
+    api.session = FakeSession(
+        make_fake_response(502, {'error': 'bad gateway'}),
+        make_fake_response(200, {'data': []}),
+        make_fake_response(200, {}),
+        make_fake_response(404, {'error': 'not found'}),
+    )
+
+    api.get_address_book(user_id=1)
+    api.post_invites_sent(entries=[{'user_id': '1', 'email': 'a@example.org'}])
+    with pytest.raises(HTTPError):
+        api.get_address_book(user_id=2)
+
+    assert [(t.method, t.endpoint, t.status, t.retries) for t in traces] == [
+        ('GET', '/address-book/1', 200, 1),
+        ('POST', '/invites-sent', 200, 0),
+        ('GET', '/address-book/2', 404, 0),
+    ]
+    assert list(traces[0].timings) == ['prepare', 'send', 'read', 'decode']
+    assert list(traces[1].timings) == ['encode', 'prepare', 'send', 'read', 'decode']
+    assert traces[1].request_bytes == len(b'{"entries":[{"user_id":"1","email":"a@example.org"}]}')
+    assert traces[1].response_bytes == 2
+    assert traces[0].error is None and isinstance(traces[2].error, HTTPError)
+
+    snapshot = histograms.snapshot()
+    assert sorted(snapshot) == ['GET /address-book', 'POST /invites-sent']
+    assert snapshot['GET /address-book']['total']['count'] == 2
+    assert snapshot['GET /address-book']['errors'] == 1
+    assert set(snapshot['POST /invites-sent']['encode']) == {'count', 'max', 'mean', 'p50', 'p95', 'p99'}
+
+
+def test_request_observers_skipped_upload():
+    traces = []
+    api = YesGraphAPI(secret_key='foo', observers=[traces.append], address_book_fingerprints=TTLCache())
+    api.session = FakeSession(make_fake_response(200, {}), make_fake_response(200, {'data': []}))
+    entries = [{'name': 'Foo', 'emails': ['foo@example.org']}]
+
+    api.post_address_book(user_id=1, entries=entries, source_type='ios')
+    assert api.post_address_book(user_id=1, entries=entries, source_type='ios') == {}
+    api.get_address_book(user_id=1)
+
+    assert [(t.method, t.endpoint) for t in traces] == [('POST', '/address-book'), ('GET', '/address-book/1')]
+    assert 'encode' in traces[0].timings
+    assert 'encode' not in traces[1].timings
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for ms in range(1, 1001):
+        histogram.add(ms / 1000.0)
+    assert 0.5 <= histogram.percentile(50) <= 0.5 * 1.05
+    assert 0.99 <= histogram.percentile(99) <= 0.99 * 1.05
+    assert histogram.percentile(100) == histogram.max == 1.0
+
+
+def test_request_gives_up(sleeps):
+    api = YesGraphAPI(secret_key='foo', retry=RetryPolicy(max_retries=2))
+    api.session = FakeSession(*[make_fake_response(500, {'error': 'oops'})] * 3)
+
+    with pytest.raises(HTTPError):
+        api.get_address_book(user_id=1)
+    assert len(api.session.sent) == 3
+
+    # A POST that may have been processed is not retried
+    api.session = FakeSession(make_fake_response(500, {'error': 'oops'}))
+    with pytest.raises(HTTPError):
+        api.post_invites_sent(entries=[{'user_id': '1'}])
+    assert len(api.session.sent) == 1
+
+    api.session = FakeSession(ConnectionError('connection reset'))
+    with pytest.raises(ConnectionError):
+        api.post_invites_sent(entries=[{'user_id': '1'}])
+
+    # ...but one that never reached the server is
+    api.session = FakeSession(ConnectTimeout('timed out'), make_fake_response(200, {}))
+    assert api.post_invites_sent(entries=[{'user_id': '1'}]) == {}
+    assert len(api.session.sent) == 2
+
+
+def test_request_without_retry_policy():
+    api = YesGraphAPI(secret_key='foo')
+    api.session = FakeSession(make_fake_response(503, {'error': 'unavailable'}))
+    with pytest.raises(HTTPError):
+        api.test()
+
+
+def test_timeouts_per_endpoint():
+    timeouts = Timeouts({'/address-book': (5, 120), '/test': None, '*': 3})
+    assert timeouts.for_endpoint('/address-book/1234') == (5, 120)
+    assert timeouts.for_endpoint('/invites-sent') == (3, 3)
+    assert timeouts.for_endpoint('/test') is None
+    assert Timeouts({'/test': 1}).for_endpoint('/users') == DEFAULT_TIMEOUT
+    assert Timeouts(None).for_endpoint('/users') is None
+
+    # Shortened to what is left of the deadline
+    deadline = Deadline(2)
+    connect, read = timeouts.for_endpoint('/address-book/1234', deadline)
+    assert 1.9 < connect <= 2 and 1.9 < read <= 2
+    connect, read = timeouts.for_endpoint('/test', deadline)
+    assert 1.9 < connect <= 2 and 1.9 < read <= 2
+
+    api = YesGraphAPI(secret_key='foo', timeout={'/address-book': (5, 120)})
+    api.session = FakeSession(make_fake_response(200, {}), make_fake_response(200, {}))
+    api.get_address_book(user_id=1)
+    api.test()
+    assert api.session.timeouts == [(5, 120), DEFAULT_TIMEOUT]
+
+
+def test_timeouts_raise_yesgraph_timeout():
+    api = YesGraphAPI(secret_key='foo')
+    api.session = FakeSession(ReadTimeout('read timed out'))
+    with pytest.raises(YesGraphTimeout) as excinfo:
+        api.get_address_book(user_id=1)
+    assert 'GET /address-book/1 timed out' in str(excinfo.value)
+
+    # Unless they are retried
+    api.retry = RetryPolicy(backoff_base=0)
+    api.session = FakeSession(ConnectTimeout('timed out'), make_fake_response(200, {}))
+    assert api.post_invites_sent(entries=[{'user_id': '1'}]) == {}
+
+    api.session = FakeSession(ConnectionError('connection reset'))
+    with pytest.raises(ConnectionError):
+        api.post_invites_sent(entries=[{'user_id': '1'}])
+
+
+def test_deadline(sleeps):
+    api = YesGraphAPI(secret_key='foo', retry=RetryPolicy(max_retries=5))
+    api.session = FakeSession()
+    with pytest.raises(YesGraphTimeout):
+        api.test(deadline=0)
+    assert api.session.sent == []
+
+    # No retry is made that would end past the deadline
+    api.session = FakeSession(make_retry_after_response(503, '0.5'), make_retry_after_response(503, '5'))
+    with pytest.raises(HTTPError):
+        api.get_address_book(user_id=1, deadline=2)
+    assert sleeps == [0.5]
+    assert len(api.session.sent) == 2
+
+    # A deadline is shared by all chunks of a batch, and by several calls
+    deadline = Deadline(60)
+    api.session = FakeSession(make_fake_response(200, {}), make_fake_response(200, {}))
+    result = api.post_invites_sent(entries=[{'user_id': '1'}, {'user_id': '2'}], chunk_size=1, deadline=deadline)
+    assert result.ok
+    deadline.expires = 0  # passed
+    result = api.post_invites_sent(entries=[{'user_id': '3'}, {'user_id': '4'}], chunk_size=1, deadline=deadline)
+    assert [type(outcome.error) for outcome in result.failed] == [YesGraphTimeout] * 2
+    assert len(api.session.sent) == 2
+
+
+def test_token_bucket(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1)  # bucket is empty, wait for the next token
+    assert bucket.reserve() == pytest.approx(0.2)
+
+    now[0] += 10  # refills up to capacity only
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1)
+
+
+def test_file_token_bucket_is_shared(tmpdir, monkeypatch):
+    pytest.importorskip('fcntl')
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    path = str(tmpdir.join('bucket'))
+    first = FileTokenBucket(path, rate=1, capacity=2)
+    second = FileTokenBucket(path, rate=1, capacity=2)  # e.g. in another process
+
+    assert first.reserve() == 0
+    assert second.reserve() == 0
+    assert first.reserve() == pytest.approx(1.0)
+    assert second.reserve() == pytest.approx(2.0)
+
+
+def test_rate_limiter_per_endpoint(sleeps):
+    address_book = TokenBucket(rate=1, capacity=1)
+    default = TokenBucket(rate=1000, capacity=1000)
+    limiter = RateLimiter({'/address-book': address_book, '*': default})
+
+    assert limiter.bucket_for('/address-book/1234') is address_book
+    assert limiter.bucket_for('address-book') is address_book
+    assert limiter.bucket_for('/invites-sent') is default
+    assert RateLimiter({}).bucket_for('/test') is None
+
+    api = YesGraphAPI(secret_key='foo', rate_limiter=limiter)
+    api.session = FakeSession(*[make_fake_response(200, {})] * 4)
+    api.get_address_book(user_id=1)
+    api.post_invites_sent(entries=[{'user_id': '1'}])
+    api.post_invites_sent(entries=[{'user_id': '1'}])
+    assert sleeps == []
+    api.get_address_book(user_id=1)
+    assert len(sleeps) == 1 and 0 < sleeps[0] <= 1
+
+
+def test_connection_pool_options():
+    api = YesGraphAPI(secret_key='foo', pool_connections=2, pool_maxsize=32, pool_block=True)
+    adapter = api.session.get_adapter('https://api.yesgraph.com/v0/test')
+    assert adapter._pool_connections == 2
+    assert adapter._pool_maxsize == 32
+    assert adapter._pool_block is True
+    assert api.session.headers['Connection'] == 'keep-alive'
+
+    api = YesGraphAPI(secret_key='foo', keep_alive=False)
+    assert api._prepare_request('GET', '/test').headers['Connection'] == 'close'
+
+
+@pytest.mark.parametrize('keep_alive', [True, False])
+def test_fast_prepare_matches_session_prepare(keep_alive):
+    api = YesGraphAPI(secret_key='foo', keep_alive=keep_alive, compress_threshold=100)
+    requests = [
+        ('GET', '/address-book/john doe', None, {'limit': 10, 'filter_blank_names': None}),
+        ('POST', '/invites-sent', b'{"entries":[]}', {}),
+        ('POST', '/address-book', b'{"entries":[' + b'{},' * 100 + b'{}]}', {}),
+        ('DELETE', '/address-book/1', None, {}),
+    ]
+    for method, endpoint, data, url_args in requests:
+        fast = api._prepare_fast(method, endpoint, data, **url_args)
+        slow = api._prepare_with_session(api.session, method, endpoint, data, **url_args)
+        assert (fast.method, fast.url, dict(fast.headers)) == (slow.method, slow.url, dict(slow.headers))
+        assert fast.body == slow.body
+
+    fast = api._prepare_fast('POST', '/address-book', iter([b'{"entries":', b'[]}']))
+    assert fast.headers['Transfer-Encoding'] == 'chunked'
+
+    # changing settings is picked up
+    api.secret_key = 'bar'
+    api.base_url = 'http://localhost:8000/v0'
+    req = api._prepare_request('GET', '/test')
+    assert req.url == 'http://localhost:8000/v0/test'
+    assert req.headers['Authorization'] == 'Bearer bar'
+
+
+def test_session_headers_and_hooks_are_kept():
+    def hook(response, **kwargs):
+        return response
+
+    api = YesGraphAPI(secret_key='foo')
+    assert api._is_plain_session(api.session)
+    api.session.headers['X-Tenant'] = 'acme'
+    req = api._prepare_request('GET', '/test')
+    assert req.headers['X-Tenant'] == 'acme'
+    assert req.headers['Authorization'] == 'Bearer foo'
+
+    api.session = Session()
+    assert api._is_plain_session(api.session)
+    api.session.hooks['response'].append(hook)
+    req = api._prepare_request('GET', '/test')
+    assert req.hooks == {'response': [hook]}
+
+
+def test_import_and_construction_are_lazy():
+    # A new interpreter, as this one has long imported requests
+    code = ('import sys, yesgraph\n'
+            'api = yesgraph.YesGraphAPI("foo")\n'
+            'assert "requests" not in sys.modules and api._session is None\n'
+            'api.session\n'
+            'assert "requests" in sys.modules and api._session is not None\n')
+    subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_lazy_module():
+    module = LazyModule('json')
+    assert 'dumps' not in vars(module)
+    assert module.dumps([1]) == '[1]'
+    assert 'dumps' in vars(module)
+    with pytest.raises(AttributeError):
+        module.nope
+
+
+def test_session_sharing_between_threads():
+    def sessions(api):
+        seen = []
+        threads = [threading.Thread(target=lambda: seen.append(api.session)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return seen
+
+    shared = YesGraphAPI(secret_key='foo')
+    assert all(session is shared.session for session in sessions(shared))
+
+    per_thread = YesGraphAPI(secret_key='foo', session_per_thread=True)
+    assert per_thread.session is per_thread.session
+    seen = sessions(per_thread)
+    assert len(set(map(id, seen + [per_thread.session]))) == 5
+
+
+class SlowYesGraphAPI(SafeYesGraphAPI):
+    """Answers address book requests after a delay that depends on the user."""
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        user_id = endpoint.rsplit('/', 1)[-1]
+        if user_id == 'bad':
+            raise HTTPError('404 Client Error')
+        time.sleep(int(user_id) / 100.0)
+        return {'user_id': user_id, 'limit': url_args['limit']}
+
+
+def test_get_address_books():
+    api = SlowYesGraphAPI(secret_key='foo')
+
+    results = list(api.get_address_books(['5', '1', 'bad', '3'], concurrency=4, limit=10))
+
+    # in completion order, with errors reported per user
+    assert [r.user_id for r in results] == ['bad', '1', '3', '5']
+    assert isinstance(results[0].error, HTTPError)
+    assert results[0].result is None
+    assert [r.result for r in results[1:]] == [{'user_id': u, 'limit': 10} for u in ('1', '3', '5')]
+    assert all(r.error is None for r in results[1:])
+
+
+class CountingYesGraphAPI(SafeYesGraphAPI):
+    """Answers every request with a fresh response, counting the requests sent."""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingYesGraphAPI, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        self.requests.append((method, endpoint))
+        return {'request': len(self.requests)}
+
+
+def test_ttl_cache(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('1', 'a', 'one-a')
+    cache.set('1', 'b', 'one-b')
+    assert cache.get('1', 'a') == 'one-a'
+    cache.set('2', 'a', 'two-a')  # evicts the least recently used: ('1', 'b')
+    assert cache.get('1', 'b') is None
+    assert cache.get('1', 'a') == 'one-a'
+    assert cache.get('2', 'a') == 'two-a'
+
+    cache.invalidate('1')
+    assert cache.get('1', 'a') is None
+    assert cache.get('2', 'a') == 'two-a'
+
+    now[0] += 11
+    assert cache.get('2', 'a') is None
+    assert cache.stats() == {'hits': 4, 'misses': 3, 'size': 0}
+
+
+def test_sqlite_cache(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    path = str(tmpdir.join('cache.db'))
+
+    cache = SQLiteCache(path, maxsize=2, ttl=10)
+    cache.set('1', 'a', {'data': ['one-a']})
+    now[0] += 1
+    cache.set('1', 'b', {'data': ['one-b']})
+    now[0] += 1
+    assert cache.get('1', 'a') == {'data': ['one-a']}
+    now[0] += 1
+    cache.set('2', 'a', {'data': ['two-a']})
+    assert cache.get('1', 'b') is None
+    assert len(cache) == 2
+
+    shared = SQLiteCache(path, maxsize=2, ttl=10)  # e.g. in another process
+    assert shared.get('2', 'a') == {'data': ['two-a']}
+    shared.invalidate('2')
+    assert cache.get('2', 'a') is None
+
+    now[0] += 11
+    assert cache.get('1', 'a') is None
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'size': 0}
+    cache.close()
+    shared.close()
+
+
+def test_address_book_cache():
+    cache = TTLCache()
+    api = CountingYesGraphAPI(secret_key='foo', address_book_cache=cache)
+
+    first = api.get_address_book(user_id=1, limit=10, filter_blank_names=True)
+    assert api.get_address_book(user_id=1, filter_blank_names=True, limit=10) == first
+    assert api.get_address_book(user_id=1, limit=20) != first
+    assert api.get_address_book(user_id=2, limit=10, filter_blank_names=True) != first
+    assert len(api.requests) == 3
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # writes invalidate the user's cached address books
+    api.post_address_book(user_id=1, entries=[], source_type='gmail')
+    assert api.get_address_book(user_id=1, limit=10, filter_blank_names=True) != first
+    api.get_address_book(user_id=2, limit=10, filter_blank_names=True)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    api.delete_address_book(user_id=1)
+    api.get_address_book(user_id=1, limit=10, filter_blank_names=True)
+    assert (cache.hits, cache.misses) == (2, 5)
+
+
+def test_address_book_fingerprints(tmpdir):
+    fingerprints = SQLiteCache(str(tmpdir.join('fingerprints.db')), ttl=3600)
+    api = CountingYesGraphAPI(secret_key='foo', address_book_fingerprints=fingerprints)
+    entries = [{'name': 'Foo', 'emails': ['foo@example.org']}]
+
+    assert api.post_address_book(user_id=1, entries=entries, source_type='ios') == {'request': 1}
+    assert api.post_address_book(user_id=1, entries=iter(entries), source_type='ios') == {'request': 1}
+    assert api.post_address_book(user_id=2, entries=entries, source_type='ios') == {'request': 2}
+    assert api.post_address_book(user_id=1, entries=entries, source_type='gmail') == {'request': 3}
+    assert api.post_address_book(user_id=1, entries=entries + entries, source_type='ios') == {'request': 4}
+    assert api.post_address_book(user_id=1, entries=entries + entries, source_type='ios') == {'request': 4}
+    assert len(api.requests) == 4
+
+    api.delete_address_book(user_id=1)
+    assert api.post_address_book(user_id=1, entries=entries, source_type='ios') == {'request': 6}
+    assert api.post_address_book(user_id=2, entries=entries, source_type='ios') == {'request': 2}
+
+    # failed uploads are not recorded
+    flaky = FlakyYesGraphAPI(secret_key='foo', address_book_fingerprints=TTLCache())
+    with pytest.raises(HTTPError):
+        flaky.post_address_book(user_id=1, entries=[{'name': 'bad'}], source_type='ios')
+    assert len(flaky.address_book_fingerprints) == 0
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    keys = [str(i).encode('ascii') for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(str(i).encode('ascii') in bloom for i in range(1000, 11000))
+    assert false_positives < 200
+    assert len(bloom._bits) < 1300
+
+
+def test_rotating_bloom_filter(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    bloom = RotatingBloomFilter(capacity=100, window=60)
+    bloom.add(b'a')
+    now[0] += 59
+    assert b'a' in bloom
+    now[0] += 1
+    bloom.add(b'b')
+    assert b'a' in bloom  # in the previous generation
+    now[0] += 60
+    assert b'a' not in bloom and b'b' in bloom
+
+    # full generations rotate early
+    for i in range(250):
+        bloom.add(str(i).encode('ascii'))
+    assert b'b' not in bloom and b'249' in bloom
+
+
+def test_event_dedup():
+    api = FlakyYesGraphAPI(secret_key='foo', event_dedup=RotatingBloomFilter(capacity=1000))
+    seen = [{'user_id': '1', 'emails': ['a@example.org', 'b@example.org']},
+            {'user_id': '1', 'emails': ['a@example.org']},
+            {'user_id': '2', 'emails': ['a@example.org']}]
+    assert api.post_suggested_seen(entries=seen)['entries'] == [seen[0], seen[2]]
+    assert api.post_suggested_seen(entries=seen) is None
+    more = [{'user_id': '1', 'emails': ['a@example.org', 'c@example.org']}, {'user_id': '1', 'name': 'x'}]
+    assert api.post_suggested_seen(entries=seen + more)['entries'] == more
+
+    # the same pair was not reported to another endpoint yet
+    sent = [InviteEvent('1', email='a@example.org'), {'user_id': '1', 'phone': '+14155551234'}]
+    assert len(api.post_invites_sent(entries=sent)['entries']) == 2
+    assert api.post_invites_sent(entries=sent) is None
+
+    # failed chunks are not remembered
+    entries = [{'user_id': 'bad', 'email': 'a@example.org'}, {'user_id': '3', 'email': 'a@example.org'}]
+    result = api.post_invites_sent(entries=entries, chunk_size=1)
+    assert result.failed_entries() == entries[:1]
+    result = api.post_invites_sent(entries=entries, chunk_size=1)
+    assert result.failed_entries() == entries[:1] and len(result.succeeded) == 0
+
+
+class ClientKeyYesGraphAPI(SafeYesGraphAPI):
+    """Slowly mints client keys, counting the requests sent."""
+
+    def __init__(self, *args, **kwargs):
+        super(ClientKeyYesGraphAPI, self).__init__(*args, **kwargs)
+        self.minted = []
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        user_id = json.loads(data)['user_id']
+        if user_id == 'bad':
+            raise HTTPError('500 Server Error')
+        self.minted.append(user_id)
+        time.sleep(0.05)
+        return {'client_key': 'key-{0}-{1}'.format(user_id, len(self.minted))}
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['result'] * 8
+    assert len(calls) == 1
+
+    with pytest.raises(KeyError):
+        flight.do('key', lambda: {}['missing'])
+    assert flight.do('key', lambda: 'again') == 'again'
+
+
+def test_client_key_cache():
+    api = ClientKeyYesGraphAPI(secret_key='foo', client_key_cache=TTLCache(ttl=60))
+
+    keys = []
+    threads = [threading.Thread(target=lambda: keys.append(api.get_client_key(1234))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert keys == ['key-1234-1'] * 8
+    assert api.get_client_key('1234') == 'key-1234-1'
+    assert api.minted == ['1234']
+
+    # without a cache, every call mints a new key
+    api = ClientKeyYesGraphAPI(secret_key='foo')
+    assert api.get_client_key(1) != api.get_client_key(1)
+    with pytest.raises(ValueError):
+        api.prewarm_client_keys([1, 2])
+
+
+def test_prewarm_client_keys():
+    api = ClientKeyYesGraphAPI(secret_key='foo', client_key_cache=TTLCache(ttl=60))
+
+    errors = api.prewarm_client_keys(['1', '2', 'bad', '3', '2'], concurrency=3)
+
+    assert list(errors) == ['bad']
+    assert isinstance(errors['bad'], HTTPError)
+    assert sorted(api.minted) == ['1', '2', '3']
+    api.get_client_key('3')
+    assert len(api.minted) == 3
+
+
+def test_iter_json_body():
+    doc = {'user_id': '1', 'source': {'type': 'gmail'}, 'entries': None}
+    entries = [{'name': u'J\xf6rg', 'email': 'user{0}@example.org'.format(i)} for i in range(1000)]
+
+    consumed = []
+
+    def contacts():
+        for entry in entries:
+            consumed.append(entry)
+            yield entry
+
+    chunks = iter_json_body(doc, 'entries', contacts(), buffer_size=1024)
+    first = next(chunks)
+    assert 0 < len(consumed) < 100  # lazily consumed
+    body = first + b''.join(chunks)
+    assert json.loads(body.decode('utf-8')) == dict(doc, entries=entries)
+
+    assert json.loads(b''.join(iter_json_body({}, 'entries', iter([]))).decode('utf-8')) == {'entries': []}
+
+
+@pytest.mark.parametrize('codec', [JSONCodec(), default_codec])
+def test_records(codec):
+    contact = Contact('John Doe', emails=['john@example.org'])
+    assert json.loads(contact.encode(codec.dumps)) == {'name': 'John Doe', 'emails': ['john@example.org']}
+    assert contact == Contact('John Doe', ('john@example.org',))
+    assert hash(contact) == hash(Contact('John Doe', ('john@example.org',)))
+    assert len({contact, Contact('John Doe', ('john@example.org',)), Contact('Jane Doe')}) == 2
+    assert not hasattr(contact, '__dict__')
+
+    event = InviteEvent(42, phone='+1 555 222 3333', sent_at=datetime(2015, 3, 28, 20, 16, 12))
+    assert json.loads(event.encode(codec.dumps)) == event.to_dict() == {
+        'user_id': '42', 'phone': '+1 555 222 3333', 'sent_at': '2015-03-28T20:16:12'}
+
+
+def test_address_book_batch():
+    contacts = [Contact('Foo', emails=['foo@example.org']), Contact(phones=['+1 555 222 3333'])]
+    batch = AddressBookBatch.from_contacts(contacts)
+    assert len(batch) == 2
+    assert list(batch) == contacts
+    batch.validate()
+
+    batch.append('Nobody')
+    with pytest.raises(ValueError):
+        batch.validate()
+    with pytest.raises(ValueError):
+        AddressBookBatch(['Foo'], [('foo@example.org',)], []).validate()
+    with pytest.raises(ValueError):
+        AddressBookBatch(['Foo'], ['foo@example.org'], [()]).validate()
+    with pytest.raises(ValueError):
+        batch.append('Foo', emails='foo@example.org')
+    assert len(batch.names) == len(batch.emails) == len(batch.phones) == 3
+    with pytest.raises(ValueError):
+        Contact('Foo', phones='+1 555 222 3333')
+
+
+@pytest.mark.parametrize('codec', [JSONCodec(), default_codec])
+def test_records_encoded_in_slices(codec):
+    contacts = [Contact('Contact {0}'.format(i) if i % 3 else None, emails=['c{0}@example.org'.format(i)],
+                        phones=['+1 555 222 {0:04d}'.format(i)] if i % 2 else ()) for i in range(2500)]
+    expected = {'entries': [contact.to_dict() for contact in contacts]}
+    for entries in (contacts, AddressBookBatch.from_contacts(contacts), iter(contacts)):
+        body = b''.join(iter_json_body({}, 'entries', entries, codec=codec))
+        assert json.loads(body.decode('utf-8')) == json.loads(json.dumps(expected))
+
+
+def test_endpoint_post_records(api):
+    batch = AddressBookBatch()
+    batch.append('Foo', emails=['foo@example.org'])
+    batch.append(None, phones=['+1 555 222 3333'])
+    req = api.post_address_book(user_id=1234, entries=batch, source_type='gmail')
+    assert json.loads(req.body)['entries'] == [
+        {'name': 'Foo', 'emails': ['foo@example.org']},
+        {'phones': ['+1 555 222 3333']},
+    ]
+
+    batch.append('Nobody')
+    with pytest.raises(ValueError):
+        api.post_address_book(user_id=1234, entries=batch, source_type='gmail')
+
+    req = api.post_address_book(user_id=1234, entries=[Contact('Foo', emails=['foo@example.org'])],
+                                source_type='gmail')
+    assert json.loads(req.body)['entries'] == [{'name': 'Foo', 'emails': ['foo@example.org']}]
+
+    events = [InviteEvent(1, email='jane@example.org'), {'user_id': '2', 'email': 'john@example.org'}]
+    req = api.post_invites_sent(entries=events)
+    assert json.loads(req.body) == {'entries': [
+        {'user_id': '1', 'email': 'jane@example.org'},
+        {'user_id': '2', 'email': 'john@example.org'},
+    ]}
+
+    result = api.post_invites_sent(entries=events, chunk_size=1)
+    assert [json.loads(o.result.body) for o in result.succeeded] == [
+        {'entries': [{'user_id': '1', 'email': 'jane@example.org'}]},
+        {'entries': [{'user_id': '2', 'email': 'john@example.org'}]},
+    ]
+
+
+def test_normalize_phone():
+    assert normalize_phone('+1 (415) 555-1234') == '+14155551234'
+    assert normalize_phone('0049 30 1234567') == '+49301234567'
+    assert normalize_phone('030 1234567', default_country_code='+49') == '+49301234567'
+    assert normalize_phone('415.555.1234') == '4155551234'
+    assert normalize_phone(' - ') is None
+
+
+def test_normalize_contacts():
+    entries = [
+        {'name': 'John', 'emails': [' John@Example.org ', 'john@example.org'], 'source_id': 1},
+        {'name': ' ', 'email': 'jane@example.org'},
+        {'name': 'Johnny', 'emails': ['JOHN@example.org'], 'phones': ['+1 415 555 1234']},
+        {'name': 'Jane Doe', 'phone': '+1 (415) 555-0000', 'emails': ['jane@EXAMPLE.org']},
+        {'name': 'Mobile', 'phones': ['+14155551234']},
+        {'name': 'Nobody'},
+    ]
+    result, removed = normalize_contacts(iter(entries))
+    assert removed == 3
+    assert result == [
+        {'name': 'John', 'emails': ['john@example.org'], 'phones': ['+14155551234'], 'source_id': 1},
+        {'name': 'Jane Doe', 'emails': ['jane@example.org'], 'phones': ['+14155550000']},
+        {'name': 'Nobody'},
+    ]
+
+    contacts = [Contact('A', ['a@example.org']), Contact(None, ['A@example.org', 'b@example.org'])]
+    assert normalize_contacts(contacts) == ([Contact('A', ['a@example.org', 'b@example.org'])], 1)
+
+    batch, removed = normalize_contacts(AddressBookBatch.from_contacts(contacts))
+    assert list(batch) == [Contact('A', ['a@example.org', 'b@example.org'])] and removed == 1
+
+    # C shows that A and B are the same person
+    contacts = [Contact('A', ['a@example.org']), Contact('B', phones=['+14155550000']),
+                Contact(None, ['x@example.org']), Contact('C', ['b@example.org', 'A@example.org'], ['+1 415 555 0000'])]
+    assert normalize_contacts(contacts) == ([
+        Contact('A', ['a@example.org', 'b@example.org'], ['+14155550000']),
+        Contact(None, ['x@example.org']),
+    ], 2)
+    entries = [{'name': 'A', 'email': 'a@example.org', 'source_id': 1}, {'email': 'b@example.org'},
+               {'email': 'c@example.org'}, {'emails': ['c@example.org', 'b@example.org']},
+               {'name': 'D', 'emails': ['a@example.org', 'c@example.org']}]
+    assert normalize_contacts(entries) == ([
+        {'name': 'A', 'emails': ['a@example.org', 'b@example.org', 'c@example.org'], 'source_id': 1},
+    ], 4)
+
+
+def test_endpoint_post_address_book_normalize(api):
+    entries = [{'name': 'Foo', 'email': 'Foo@example.org'}, {'name': 'Bar', 'emails': ['foo@example.org ']}]
+    req = api.post_address_book(user_id=1234, entries=(e for e in entries), source_type='gmail', normalize=True)
+    assert json.loads(req.body)['entries'] == [{'name': 'Foo', 'emails': ['foo@example.org']}]
+
+
+def test_endpoint_post_address_book_streaming(api):
+    ENTRIES = [
+        {'name': 'Foo', 'email': 'foo@example.org'},
+        {'name': 'Bar', 'email': 'bar@example.org'},
+    ]
+    req = api.post_address_book(user_id=1234, entries=(e for e in ENTRIES), source_type='gmail', limit=20)
+    assert req.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in req.headers
+
+    assert json.loads(b''.join(req.body).decode('utf-8')) == {
+        'user_id': '1234',
+        'source': {'type': 'gmail'},
+        'filter_suggested_seen': None,
+        'filter_existing_users': None,
+        'filter_invites_sent': None,
+        'filter_blank_names': None,
+        'promote_existing_users': None,
+        'promote_matching_domain': None,
+        'entries': ENTRIES,
+        'limit': 20,
+        'backfill': None
+    }
+
+
+def test_streamed_requests_are_not_retried():
+    api = YesGraphAPI(secret_key='foo', retry=RetryPolicy())
+    api.session = FakeSession(make_fake_response(503, {'error': 'unavailable'}))
+    with pytest.raises(HTTPError):
+        api.post_address_book(user_id=1, entries=iter([{'email': 'foo@example.org'}]), source_type='gmail')
+    assert len(api.session.sent) == 1
+
+
+def gunzip(body):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+
+def test_request_compression():
+    api = SafeYesGraphAPI(secret_key='foo', compress_threshold=1024)
+    small = [{'user_id': '1', 'email': 'foo@example.org'}]
+    large = small * 100
+
+    req = api.post_invites_sent(entries=small)
+    assert 'Content-Encoding' not in req.headers
+    assert json.loads(req.body) == {'entries': small}
+
+    req = api.post_invites_sent(entries=large)
+    assert req.headers['Content-Encoding'] == 'gzip'
+    assert int(req.headers['Content-Length']) == len(req.body) < 1024
+    assert json.loads(gunzip(req.body).decode('utf-8')) == {'entries': large}
+
+    req = api.post_address_book(user_id=1, entries=iter(large), source_type='gmail')
+    assert req.headers['Content-Encoding'] == 'gzip'
+    assert req.headers['Transfer-Encoding'] == 'chunked'
+    assert json.loads(gunzip(b''.join(req.body)).decode('utf-8'))['entries'] == large
+
+    # disabled by default
+    req = SafeYesGraphAPI(secret_key='foo').post_invites_sent(entries=large)
+    assert 'Content-Encoding' not in req.headers
+
+
+def test_accept_encoding(api):
+    req = api.test()
+    assert req.headers['Accept-Encoding'] == 'gzip, deflate'
+
+
+def test_json_array_parser():
+    contacts = [
+        {'name': u'J\xf6rg [the "boss"]', 'emails': ['a@example.org'], 'score': 0.25},
+        {'name': 'Empty', 'emails': [], 'nested': {'data': [1, 2]}},
+        12345,
+        None,
+    ]
+    text = json.dumps({'meta': {'data': 'not this one'}, 'data': contacts, 'total': 100})
+
+    for piece_size in (1, 2, 7, len(text)):
+        parser = JSONArrayParser('data')
+        items = []
+        for i in range(0, len(text), piece_size):
+            items.extend(parser.feed(text[i:i + piece_size]))
+        parser.close()
+        assert items == contacts
+
+    parser = JSONArrayParser('data')
+    assert parser.feed('{"data": [], "meta": {}}') == []
+    parser.close()
+
+    parser = JSONArrayParser('data')
+    assert parser.feed('{"error": "no data"}') == []
+    parser.close()
+
+    parser = JSONArrayParser('data')
+    parser.feed('{"data": [1, 2')
+    with pytest.raises(ValueError):
+        parser.close()
+
+    with pytest.raises(ValueError):
+        JSONArrayParser('data').feed('[1, 2, 3]')
+
+
+def test_iter_address_book():
+    contacts = [{'name': 'Contact {0}'.format(i), 'emails': ['{0}@example.org'.format(i)]} for i in range(1000)]
+    api = YesGraphAPI(secret_key='foo')
+    api.session = FakeSession(make_fake_response(200, {'meta': {}, 'data': contacts}))
+
+    stream = api.iter_address_book(user_id=1234, limit=1000)
+    assert next(stream) == contacts[0]
+    assert api.session.sent[0].url == 'https://api.yesgraph.com/v0/address-book/1234?limit=1000'
+    assert list(stream) == contacts[1:]
+
+    # stopping early
+    api.session = FakeSession(make_fake_response(200, {'meta': {}, 'data': contacts}))
+    top = []
+    for contact in api.iter_address_book(user_id=1234):
+        top.append(contact)
+        if len(top) == 10:
+            break
+    assert top == contacts[:10]
+
+    api.session = FakeSession(make_fake_response(404, {'error': 'not found'}))
+    with pytest.raises(HTTPError):
+        list(api.iter_address_book(user_id=1234))
+
+
+class DomainEmailsYesGraphAPI(SafeYesGraphAPI):
+    """Serves `size` emails per domain, in pages."""
+
+    def __init__(self, *args, **kwargs):
+        self.sizes = kwargs.pop('sizes')
+        super(DomainEmailsYesGraphAPI, self).__init__(*args, **kwargs)
+        self.pages = []
+
+    def _request(self, method, endpoint, data=None, **url_args):
+        domain = endpoint.rsplit('/', 1)[-1]
+        if domain == 'bad.com':
+            raise HTTPError('500 Server Error')
+        page, batch_size = url_args['page'], url_args['batch_size']
+        self.pages.append((domain, page))
+        emails = ['{0}@{1}'.format(i, domain) for i in range(self.sizes[domain])]
+        return {'data': emails[(page - 1) * batch_size:page * batch_size]}
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_iter_domain_emails(prefetch):
+    api = DomainEmailsYesGraphAPI(secret_key='foo', sizes={'example.com': 25, 'even.com': 20})
+
+    emails = list(api.iter_domain_emails('example.com', batch_size=10, prefetch=prefetch))
+    assert emails == ['{0}@example.com'.format(i) for i in range(25)]
+
+    emails = list(api.iter_domain_emails('even.com', batch_size=10, prefetch=prefetch))
+    assert emails == ['{0}@even.com'.format(i) for i in range(20)]
+
+    # pages are fetched in order, at most `prefetch` past the last one
+    fetched = [page for domain, page in api.pages if domain == 'even.com']
+    assert fetched[:3] == [1, 2, 3]
+    assert len(fetched) <= 3 + prefetch
+
+
+def test_iter_domain_emails_prefetches():
+    api = DomainEmailsYesGraphAPI(secret_key='foo', sizes={'example.com': 1000})
+
+    emails = api.iter_domain_emails('example.com', batch_size=10, prefetch=3)
+    assert next(emails) == '0@example.com'
+    for _ in range(100):
+        if len(api.pages) == 4:
+            break
+        time.sleep(0.01)
+    assert sorted(api.pages) == [('example.com', page) for page in (1, 2, 3, 4)]
+    emails.close()
+
+
+def test_get_domains_emails():
+    api = DomainEmailsYesGraphAPI(secret_key='foo', sizes={'a.com': 5, 'b.com': 12, 'c.com': 0})
+
+    results = dict((r.domain, r) for r in api.get_domains_emails(['a.com', 'b.com', 'bad.com', 'c.com'],
+                                                                 batch_size=5, concurrency=2))
+
+    assert results['a.com'].emails == ['{0}@a.com'.format(i) for i in range(5)]
+    assert results['b.com'].emails == ['{0}@b.com'.format(i) for i in range(12)]
+    assert results['c.com'].emails == []
+    assert isinstance(results['bad.com'].error, HTTPError)
@@ -0,0 +1,328 @@
+import asyncio
+import json
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+
+from yesgraph import LatencyHistograms, RetryPolicy, TTLCache, YesGraphTimeout  # noqa: E402
+from yesgraph_async import AsyncYesGraphAPI  # noqa: E402
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def echo(request):
+    body = await request.text()
+    if 'bad' in body:
+        return web.json_response({'error': 'server error'}, status=500)
+    return web.json_response({
+        'method': request.method,
+        'path': request.path,
+        'query': dict(request.query),
+        'authorization': request.headers.get('Authorization'),
+        'content_encoding': request.headers.get('Content-Encoding'),
+        'body': json.loads(body) if body else None,
+        'client_key': 'key-{0}'.format(id(request)),
+    })
+
+
+async def address_book(request):
+    contacts = [{'name': 'Contact {0}'.format(i)} for i in range(int(request.query['limit']))]
+    return web.json_response({'meta': {}, 'data': contacts})
+
+
+async def domain_emails(request):
+    page, batch_size = int(request.query['page']), int(request.query['batch_size'])
+    emails = ['{0}@{1}'.format(i, request.match_info['domain']) for i in range(25)]
+    return web.json_response({'data': emails[(page - 1) * batch_size:page * batch_size]})
+
+
+async def slow(request):
+    await asyncio.sleep(1)
+    return web.json_response({})
+
+
+async def failure(request):
+    return web.json_response({'error': 'not found'}, status=404)
+
+
+class EchoServer(object):
+    """Local aiohttp app that echoes every request back as JSON."""
+
+    attempts = 0
+
+    async def unavailable_once(self, request):
+        self.attempts += 1
+        if self.attempts == 1:
+            return web.json_response({'error': 'unavailable'}, status=503, headers={'Retry-After': '0'})
+        return web.json_response({'attempts': self.attempts})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route('GET', '/v0/missing', failure)
+        app.router.add_route('GET', '/v0/address-book/missing', failure)
+        app.router.add_route('GET', '/v0/address-book/streamed', address_book)
+        app.router.add_route('GET', '/v0/domain-emails/bad.com', failure)
+        app.router.add_route('GET', '/v0/domain-emails/{domain}', domain_emails)
+        app.router.add_route('POST', '/v0/unavailable-once', self.unavailable_once)
+        app.router.add_route('GET', '/v0/slow', slow)
+        app.router.add_route('*', '/v0/{tail:.*}', echo)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = 'http://127.0.0.1:{0}/v0/'.format(port)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+
+def test_methods_return_awaitables():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                result = await api.get_address_book(user_id='user/1', limit=5)
+                assert result['method'] == 'GET'
+                assert result['path'] == '/v0/address-book/user/1'
+                assert result['query'] == {'limit': '5'}
+                assert result['authorization'] == 'Bearer foo'
+
+                entries = [{'user_id': '1', 'email': 'foo@example.org'}]
+                result = await api.post_invites_sent(entries=entries)
+                assert result['path'] == '/v0/invites-sent'
+                assert result['body'] == {'entries': entries}
+
+                # deprecated single-entry helpers go through the batch endpoint
+                result = await api.post_invite_sent(user_id=42, email='john@example.org')
+                assert result['body'] == {'entries': [{'user_id': '42', 'email': 'john@example.org'}]}
+
+                assert (await api.get_client_key(user_id=1234)).startswith('key-')
+
+    run(scenario())
+
+
+def test_concurrent_requests_share_session():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, limit=4) as api:
+                results = await asyncio.gather(*[
+                    api.test() for i in range(20)
+                ])
+                assert [r['path'] for r in results] == ['/v0/test'] * 20
+                assert api.session.connector.limit == 4
+
+    run(scenario())
+
+
+def test_response_with_error():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                with pytest.raises(aiohttp.ClientResponseError):
+                    await api._request('GET', '/missing')
+
+    run(scenario())
+
+
+def test_chunked_batch_endpoint():
+    async def scenario():
+        entries = [{'user_id': str(i), 'email': 'user{0}@example.org'.format(i)} for i in range(10)]
+        entries[7]['email'] = 'bad@example.org'
+
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                result = await api.post_suggested_seen(entries=entries, chunk_size=3, concurrency=2)
+                assert [outcome.index for outcome in result.succeeded] == [0, 1, 3]
+                assert [outcome.index for outcome in result.failed] == [2]
+                assert result.failed_entries() == entries[6:9]
+                assert [r['body']['entries'] for r in result.results] == [entries[0:3], entries[3:6], entries[9:]]
+
+    run(scenario())
+
+
+def test_retries():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, retry=RetryPolicy()) as api:
+                assert await api._request('POST', '/unavailable-once') == {'attempts': 2}
+
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                with pytest.raises(aiohttp.ClientResponseError):
+                    await api._request('POST', '/unavailable-once')
+
+    run(scenario())
+
+
+def test_observers():
+    async def scenario():
+        traces = []
+        histograms = LatencyHistograms()
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, retry=RetryPolicy(),
+                                        observers=[traces.append, histograms]) as api:
+                await api._request('POST', '/unavailable-once')
+                await api.post_alias(emails=[{'user_id': '1', 'email': 'a@example.org'}])
+                [c async for c in api.iter_address_book('streamed', limit=10)]
+
+        assert [(t.method, t.endpoint, t.status, t.retries) for t in traces] == [
+            ('POST', '/unavailable-once', 200, 1),
+            ('POST', '/alias', 200, 0),
+            ('GET', '/address-book/streamed', 200, 0),
+        ]
+        assert list(traces[1].timings) == ['encode', 'prepare', 'send', 'read', 'decode']
+        assert traces[1].request_bytes > 0 and traces[1].response_bytes > 0
+        assert histograms.snapshot()['POST /alias']['total']['count'] == 1
+
+    run(scenario())
+
+
+def test_get_address_books():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                user_ids = [str(i) for i in range(20)] + ['missing']
+                results = [r async for r in api.get_address_books(user_ids, concurrency=5, limit=3)]
+
+        assert sorted(r.user_id for r in results) == sorted(user_ids)
+        for r in results:
+            if r.user_id == 'missing':
+                assert r.result is None
+                assert r.error.status == 404
+            else:
+                assert r.error is None
+                assert r.result['path'] == '/v0/address-book/' + r.user_id
+                assert r.result['query'] == {'limit': '3'}
+
+    run(scenario())
+
+
+def test_address_book_cache():
+    async def scenario():
+        cache = TTLCache()
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, address_book_cache=cache) as api:
+                first = await api.get_address_book(user_id=1, limit=5)
+                assert await api.get_address_book(user_id=1, limit=5) is first
+                await api.post_address_book(user_id=1, entries=[], source_type='gmail')
+                assert await api.get_address_book(user_id=1, limit=5) is not first
+                assert (cache.hits, cache.misses) == (1, 2)
+
+    run(scenario())
+
+
+def test_address_book_fingerprints():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, address_book_fingerprints=TTLCache()) as api:
+                entries = [{'emails': ['foo@example.org']}]
+                first = await api.post_address_book(user_id=1, entries=entries, source_type='ios')
+                assert first is not None
+                assert (await api.post_address_book(user_id=1, entries=entries, source_type='ios')) == first
+                await api.delete_address_book(user_id=1)
+                assert (await api.post_address_book(user_id=1, entries=entries, source_type='ios')) is not None
+
+    run(scenario())
+
+
+def test_client_key_cache():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, client_key_cache=TTLCache()) as api:
+                keys = await asyncio.gather(*[api.get_client_key(1234) for _ in range(10)])
+                assert len(set(keys)) == 1
+                assert await api.get_client_key('1234') == keys[0]
+
+                assert await api.prewarm_client_keys(['1', '2', '3']) == {}
+                assert len(api.client_key_cache) == 4
+
+    run(scenario())
+
+
+def test_streaming_upload():
+    async def scenario():
+        entries = [{'email': 'user{0}@example.org'.format(i)} for i in range(5000)]
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                result = await api.post_address_book(user_id=1, entries=iter(entries), source_type='ios')
+                assert result['body']['entries'] == entries
+
+    run(scenario())
+
+
+def test_request_compression():
+    async def scenario():
+        entries = [{'email': 'user{0}@example.org'.format(i)} for i in range(500)]
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, compress_threshold=1024) as api:
+                result = await api.post_invites_sent(entries=entries)
+                assert result['body'] == {'entries': entries}
+                assert result['content_encoding'] == 'gzip'
+
+                result = await api.post_address_book(user_id=1, entries=iter(entries), source_type='ios')
+                assert result['body']['entries'] == entries
+                assert result['content_encoding'] == 'gzip'
+
+    run(scenario())
+
+
+def test_iter_address_book():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                contacts = [c async for c in api.iter_address_book('streamed', limit=2000)]
+                assert contacts == [{'name': 'Contact {0}'.format(i)} for i in range(2000)]
+
+                with pytest.raises(aiohttp.ClientResponseError):
+                    [c async for c in api.iter_address_book('missing')]
+
+    run(scenario())
+
+
+def test_iter_domain_emails():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                for prefetch in (0, 2):
+                    emails = [e async for e in api.iter_domain_emails('example.com', batch_size=10,
+                                                                      prefetch=prefetch)]
+                    assert emails == ['{0}@example.com'.format(i) for i in range(25)]
+
+                crawl = api.get_domains_emails(['a.com', 'bad.com', 'b.com'], batch_size=5, concurrency=2)
+                results = {r.domain: r async for r in crawl}
+                assert results['a.com'].emails == ['{0}@a.com'.format(i) for i in range(25)]
+                assert results['b.com'].emails == ['{0}@b.com'.format(i) for i in range(25)]
+                assert results['bad.com'].error.status == 404
+
+    run(scenario())
+
+
+def test_timeouts_and_deadline():
+    async def scenario():
+        async with EchoServer() as server:
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url, timeout={'/slow': 0.05}) as api:
+                with pytest.raises(YesGraphTimeout):
+                    await api._request('GET', '/slow')
+                assert (await api.test())['path'] == '/v0/test'
+
+            async with AsyncYesGraphAPI('foo', base_url=server.base_url) as api:
+                started = asyncio.get_event_loop().time()
+                with pytest.raises(YesGraphTimeout):
+                    await api._request('GET', '/slow', deadline=0.1)
+                assert asyncio.get_event_loop().time() - started < 0.5
+                with pytest.raises(YesGraphTimeout):
+                    await api.test(deadline=0)
+
+                books = [r async for r in api.get_address_books(['1', '2'], deadline=0)]
+                assert [type(r.error) for r in books] == [YesGraphTimeout] * 2
+
+    run(scenario())
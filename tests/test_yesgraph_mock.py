@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from requests import HTTPError
+
+from yesgraph import RetryPolicy, YesGraphAPI, YesGraphTimeout
+from yesgraph_mock import MockServer, parse_latency
+
+
+@pytest.fixture
+def server():
+    with MockServer() as server:
+        yield server
+
+
+def test_parse_latency():
+    assert parse_latency(None)() == 0
+    assert parse_latency(0.25)() == 0.25
+    assert parse_latency('fixed:0.1')() == 0.1
+    assert all(0.1 <= parse_latency('uniform:0.1,0.2')() <= 0.2 for _ in range(100))
+    assert all(parse_latency('lognormal:0.05,0.5')() > 0 for _ in range(100))
+    with pytest.raises(ValueError):
+        parse_latency('pareto:1')
+
+
+def test_mock_endpoints(server):
+    api = YesGraphAPI('secret', base_url=server.base_url)
+    assert api.test() == {'message': 'ok'}
+    assert api.get_client_key(1) == api.get_client_key('1')
+
+    entries = [{'name': 'Foo', 'emails': ['foo@example.org']}, {'name': 'Bar', 'emails': ['bar@example.org']}]
+    assert api.post_address_book(1, entries, 'gmail')['meta'] == {'total': 2}
+    assert api.get_address_book(1, limit=1)['data'] == entries[:1]
+    assert list(api.iter_address_book(1)) == entries
+    api.delete_address_book(1)
+    assert len(api.get_address_book(1, limit=50)['data']) == 50  # generated
+
+    assert api.post_invites_sent(entries=[{'user_id': '1', 'email': 'foo@example.org'}])['count'] == 1
+    assert api.post_users([{'user_id': '1'}, {'user_id': '2'}])['count'] == 2
+    assert api.post_alias(emails=[{'user_id': '1', 'emails': ['a@example.org']}])['count'] == 1
+
+    with pytest.raises(HTTPError) as excinfo:
+        api._request('POST', '/address-book', data=b'{"entries": ')
+    assert excinfo.value.response.status_code == 400
+
+
+def test_mock_pagination():
+    with MockServer(domain_size=25) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url)
+        emails = list(api.iter_domain_emails('example.com', batch_size=10))
+        assert emails == ['user{0}@example.com'.format(i) for i in range(25)]
+
+
+def test_mock_fault_injection(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+
+    with MockServer(error_rate=1.0, error_status=503) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url, retry=RetryPolicy(max_retries=2))
+        with pytest.raises(HTTPError):
+            api.test()
+        assert server.stats == {503: 3}
+
+    with MockServer(throttle_rate=1.0, retry_after=7) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url)
+        with pytest.raises(HTTPError) as excinfo:
+            api.test()
+        assert excinfo.value.response.status_code == 429
+        assert excinfo.value.response.headers['Retry-After'] == '7'
+
+    with MockServer(rate_limit=2) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url)
+        statuses = []
+        for _ in range(5):
+            try:
+                api.test()
+                statuses.append(200)
+            except HTTPError as e:
+                statuses.append(e.response.status_code)
+        assert 429 in statuses and statuses.count(200) <= 4
+
+
+def test_mock_timeouts():
+    with MockServer(latency=0.5) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url, timeout={'/test': 0.05})
+        started = time.time()
+        with pytest.raises(YesGraphTimeout):
+            api.test()
+        assert time.time() - started < 0.4
+
+        api = YesGraphAPI('secret', base_url=server.base_url)
+        with pytest.raises(YesGraphTimeout):
+            api.test(deadline=0.05)
+
+
+def test_mock_deadline_across_pages():
+    with MockServer(latency=0.05, domain_size=1000) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url)
+        emails = []
+        started = time.time()
+        with pytest.raises(YesGraphTimeout):
+            for email in api.iter_domain_emails('example.com', batch_size=10, prefetch=0, deadline=0.3):
+                emails.append(email)
+        assert 0 < len(emails) < 1000
+        assert time.time() - started < 0.5
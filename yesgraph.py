@@ -1,16 +1,57 @@
-import platform
+import atexit
+import codecs
+import functools
+import hashlib
+import importlib
+import logging
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
 import warnings
-from collections import Iterable
+import weakref
+import zlib
+from collections import OrderedDict, deque, namedtuple
+try:
+    from collections.abc import Iterable
+except ImportError:  # pragma: no cover
+    from collections import Iterable
 from datetime import datetime
+from timeit import default_timer
 import json
 
-import six
-from requests import Request, Session
 
-from six.moves.urllib.parse import quote_plus
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first used. Attributes are copied onto the stand-in as they're looked
+    up, so later lookups cost no more than on the module itself.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
+
+
+# requests (with urllib3) makes up most of the time it takes to import this
+# module, and isn't needed until the first request is sent.
+requests = LazyModule('requests')
+urllib3_exceptions = LazyModule('urllib3.exceptions')
+six = LazyModule('six')
+queue = LazyModule('six.moves.queue')
+urllib_parse = LazyModule('six.moves.urllib.parse')
 
 __version__ = '0.6.6'
 
+logger = logging.getLogger(__name__)
+
 
 def deprecation(message):
     warnings.warn(message, DeprecationWarning, stacklevel=2)
@@ -29,81 +70,1988 @@ def format_date(obj):
         raise TypeError('Cannot format {0} as a date.'.format(obj))  # pragma: no cover
 
 
+def connect_sqlite(path):
+    """
+    Opens a SQLite database for the local stores in this module: in
+    autocommit mode, usable from any thread (callers serialize access),
+    with a write-ahead log and incremental vacuuming.
+    """
+    import sqlite3
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    return db
+
+
+class JSONCodec(object):
+    """
+    Encodes request bodies to, and decodes response bodies from, JSON.
+
+    This one uses the standard library's json module. `default_codec` is the
+    fastest codec available: `OrjsonCodec`, `UjsonCodec` or `RapidjsonCodec`
+    when the corresponding package is installed, and this one otherwise.
+    """
+
+    name = 'json'
+
+    def dumps(self, obj):
+        """Encodes `obj` to UTF-8 encoded JSON bytes."""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        """Decodes UTF-8 encoded JSON bytes (or text)."""
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def __repr__(self):
+        return '<{0}>'.format(self.__class__.__name__)
+
+
+class OrjsonCodec(JSONCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        # Leave datetimes and dataclasses to `default` like json does, which raises TypeError
+        self._option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def dumps(self, obj):
+        return self._dumps(obj, option=self._option)
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class RapidjsonCodec(JSONCodec):
+    name = 'rapidjson'
+
+    def __init__(self):
+        import rapidjson
+        self._rapidjson = rapidjson
+
+    def dumps(self, obj):
+        return self._rapidjson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return self._rapidjson.loads(data)
+
+
+CODECS = (OrjsonCodec, UjsonCodec, RapidjsonCodec, JSONCodec)
+
+
+def get_codec(name=None):
+    """
+    Returns the codec called `name` ('orjson', 'ujson', 'rapidjson' or
+    'json'), or the fastest one that's installed when `name` is None.
+    """
+    for codec_class in CODECS:
+        if name is not None and codec_class.name != name:
+            continue
+        try:
+            return codec_class()
+        except ImportError:
+            if name is not None:
+                raise
+    raise ValueError('Unknown codec: {0}'.format(name))
+
+
+default_codec = get_codec()
+
+
+class Record(object):
+    """
+    Base class for compact, typed entries. Records use `__slots__` instead
+    of a per-instance dict. Fields that are None or empty are left out
+    when encoding.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def _items(self):
+        for field in self._fields:
+            value = getattr(self, field)
+            if value is not None and value != ():
+                yield field, value
+
+    def encode(self, dumps):
+        """Encodes the record as a JSON object, using the `dumps` of a codec."""
+        return dumps(self.to_dict())
+
+    def to_dict(self):
+        return dict(self._items())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self),) + tuple(getattr(self, f) for f in self._fields))
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__,
+                                 ', '.join('{0}={1!r}'.format(k, v) for k, v in sorted(self.to_dict().items())))
+
+
+def _values(values, field):
+    """Returns `values` as a tuple, raising `ValueError` for a single string."""
+    if isinstance(values, six.string_types):
+        raise ValueError('{0} must be a list, not a string: {1!r}'.format(field, values))
+    return tuple(values)
+
+
+class Contact(Record):
+    """An address book entry: a name plus tuples of emails and phone numbers."""
+
+    __slots__ = _fields = ('name', 'emails', 'phones')
+
+    def __init__(self, name=None, emails=(), phones=()):
+        self.name = name
+        self.emails = _values(emails, 'emails')
+        self.phones = _values(phones, 'phones')
+
+    def to_dict(self):
+        row = {} if self.name is None else {'name': self.name}
+        if self.emails:
+            row['emails'] = self.emails
+        if self.phones:
+            row['phones'] = self.phones
+        return row
+
+
+class InviteEvent(Record):
+    """An entry for `post_invites_sent()`."""
+
+    __slots__ = _fields = ('user_id', 'invitee_name', 'email', 'phone', 'sent_at')
+
+    def __init__(self, user_id, email=None, phone=None, invitee_name=None, sent_at=None):
+        self.user_id = str(user_id)
+        self.invitee_name = invitee_name
+        self.email = email
+        self.phone = phone
+        self.sent_at = None if sent_at is None else format_date(sent_at)
+
+
+class AddressBookBatch(object):
+    """
+    Columnar container for many address book entries, holding parallel
+    lists of names, email tuples and phone tuples instead of a dict per
+    contact. Iterating it yields `Contact` records; request bodies are
+    encoded straight from the columns, a slice of rows at a time.
+
+        batch = AddressBookBatch()
+        batch.append('John Doe', emails=['john@example.org'])
+        api.post_address_book(user_id, batch, 'gmail')
+    """
+
+    __slots__ = ('names', 'emails', 'phones')
+
+    def __init__(self, names=None, emails=None, phones=None):
+        self.names = [] if names is None else names
+        self.emails = [] if emails is None else emails
+        self.phones = [] if phones is None else phones
+
+    @classmethod
+    def from_contacts(cls, contacts):
+        batch = cls()
+        for contact in contacts:
+            batch.append(contact.name, contact.emails, contact.phones)
+        return batch
+
+    def append(self, name=None, emails=(), phones=()):
+        emails, phones = _values(emails, 'emails'), _values(phones, 'phones')
+        self.names.append(name)
+        self.emails.append(emails)
+        self.phones.append(phones)
+
+    def validate(self):
+        """
+        Checks the whole batch at once: the columns must be equally long
+        and every contact needs at least one email or phone number. Raises
+        `ValueError` otherwise.
+        """
+        if not len(self.names) == len(self.emails) == len(self.phones):
+            raise ValueError('names, emails and phones must have the same length')
+        for row, (emails, phones) in enumerate(six.moves.zip(self.emails, self.phones)):
+            if not (emails or phones):
+                raise ValueError('Contact {0} has neither emails nor phones'.format(row))
+            if isinstance(emails, six.string_types) or isinstance(phones, six.string_types):
+                raise ValueError('Contact {0} has a string where a list is expected'.format(row))
+
+    def to_dicts(self, start=0, stop=None):
+        """Returns rows `start` to `stop` as a list of dicts, leaving out empty fields like `Contact` does."""
+        names, emails, phones = self.names[start:stop], self.emails[start:stop], self.phones[start:stop]
+        if all(emails) and all(phones) and None not in names:
+            return [{'name': n, 'emails': e, 'phones': p} for n, e, p in six.moves.zip(names, emails, phones)]
+        rows = []
+        for name, emails, phones in six.moves.zip(names, emails, phones):
+            row = {} if name is None else {'name': name}
+            if emails:
+                row['emails'] = emails
+            if phones:
+                row['phones'] = phones
+            rows.append(row)
+        return rows
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for name, emails, phones in six.moves.zip(self.names, self.emails, self.phones):
+            yield Contact(name, emails, phones)
+
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_email(email):
+    """Trims and lowercases `email`. Returns None when nothing is left."""
+    return email.strip().lower() or None
+
+
+def normalize_phone(phone, default_country_code=None):
+    """
+    Brings `phone` into an E.164-like form: a '+' and the digits when the
+    country is known (written with a '+' or '00' prefix, or passed as
+    `default_country_code`), only the digits otherwise. Returns None when
+    there are no digits.
+    """
+    digits = _NON_DIGITS.sub('', phone)
+    if not digits:
+        return None
+    if phone.strip().startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if default_country_code:
+        return '+' + str(default_country_code).lstrip('+') + digits.lstrip('0')
+    return digits
+
+
+def normalize_contacts(entries, default_country_code=None):
+    """
+    Normalizes the emails and phone numbers of address book `entries` and
+    merges entries sharing an email or phone number, directly or through
+    other entries, into the first one, keeping the first name given. Takes
+    a single pass (with a union-find of the merged entries) over `entries`,
+    which may be dicts (with `emails`/`phones` lists or single `email`/
+    `phone` values), `Contact` records or an `AddressBookBatch`.
+
+    Returns `(entries, removed)`: a list of dicts or contacts in their
+    original order (or a new batch), and the number of entries merged away.
+    """
+    merged = []  # [name, emails, phones, other dict keys or None for contacts], None once merged away
+    parents = []  # index into merged -> index of the entry it was merged into, or itself
+    owners = {}  # email or phone -> index into merged (of the entry it was first seen in)
+    count = 0
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = index = parents[parents[index]]
+        return index
+
+    for entry in entries:
+        count += 1
+        if isinstance(entry, Contact):
+            name, emails, phones, extra = entry.name, entry.emails, entry.phones, None
+        else:
+            extra = dict(entry)
+            name = extra.pop('name', None)
+            emails = list(extra.pop('emails', None) or ()) + [extra.pop('email', None)]
+            phones = list(extra.pop('phones', None) or ()) + [extra.pop('phone', None)]
+
+        emails = [normalize_email(email) for email in emails if email]
+        phones = [normalize_phone(phone, default_country_code) for phone in phones if phone]
+        name = name.strip() if name else None
+
+        roots = sorted(set(find(owners[key]) for key in emails + phones if key in owners))
+        if roots:
+            index = roots[0]
+        else:
+            index = len(merged)
+            merged.append([name, [], [], extra])
+            parents.append(index)
+        contact = merged[index]
+        for other in roots[1:]:  # this entry connects entries that were separate so far
+            parents[other] = index
+            other_name, other_emails, other_phones, _ = merged[other]
+            merged[other] = None
+            if other_name and not contact[0]:
+                contact[0] = other_name
+            contact[1].extend(other_emails)
+            contact[2].extend(other_phones)
+        if name and not contact[0]:
+            contact[0] = name
+        for values, field in ((emails, 1), (phones, 2)):
+            for value in values:
+                if value and value not in owners:
+                    owners[value] = index
+                    contact[field].append(value)
+
+    merged = [contact for contact in merged if contact is not None]
+    removed = count - len(merged)
+    if isinstance(entries, AddressBookBatch):
+        return AddressBookBatch([c[0] for c in merged], [tuple(c[1]) for c in merged],
+                                [tuple(c[2]) for c in merged]), removed
+
+    result = []
+    for name, emails, phones, extra in merged:
+        if extra is None:
+            result.append(Contact(name, emails, phones))
+            continue
+        if name:
+            extra['name'] = name
+        if emails:
+            extra['emails'] = emails
+        if phones:
+            extra['phones'] = phones
+        result.append(extra)
+    return result, removed
+
+
+def iter_encoded(entries, dumps):
+    """Yields `(entry, encoded)` pairs for `entries`, which may contain `Record`s."""
+    for entry in entries:
+        yield entry, (entry.encode(dumps) if isinstance(entry, Record) else dumps(entry))
+
+
+def iter_encoded_slices(entries, dumps, slice_size=1000):
+    """
+    Yields the JSON encoding of `entries` as comma separated runs of up to
+    `slice_size` entries, with a single `dumps()` call per run. `Record`s
+    are encoded as dicts, and an `AddressBookBatch` slice by slice straight
+    from its columns. Other entries are consumed lazily, in runs that start
+    at a single entry and double in length.
+    """
+    if isinstance(entries, AddressBookBatch):
+        for start in range(0, len(entries), slice_size):
+            yield dumps(entries.to_dicts(start, start + slice_size))[1:-1]
+        return
+    rows, size = [], 1
+    for entry in entries:
+        rows.append(entry.to_dict() if isinstance(entry, Record) else entry)
+        if len(rows) >= size:
+            yield dumps(rows)[1:-1]
+            rows, size = [], min(size * 2, slice_size)
+    if rows:
+        yield dumps(rows)[1:-1]
+
+
+def has_records(entries):
+    return isinstance(entries, AddressBookBatch) or any(isinstance(entry, Record) for entry in entries)
+
+
+def _chunk_options(kwargs):
+    return dict((k, kwargs[k]) for k in ('chunk_size', 'max_chunk_bytes', 'concurrency') if k in kwargs)
+
+
+def iter_chunks(entries, key='entries', chunk_size=None, max_chunk_bytes=None, codec=None, doc=None):
+    """
+    Splits `entries` into consecutive chunks of at most `chunk_size` entries
+    whose JSON encoded request body stays within `max_chunk_bytes` bytes.
+
+    Yields `(index, entries, body)` tuples, where `body` is the encoded
+    `{key: entries}` document (or a bare list when `key` is None), as
+    bytes. The other keys of `doc`, if given, are copied into every body.
+    Every entry is only encoded once. An entry that does not fit the byte
+    budget on its own is yielded as a chunk by itself.
+    """
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+
+    dumps = (codec or default_codec).dumps
+    if key is None:
+        prefix, suffix = b'[', b']'
+    else:
+        head = dict((k, v) for k, v in (doc or {}).items() if k != key)
+        head = dumps(head)[:-1] + b',' if head else b'{'
+        prefix, suffix = head + dumps(key) + b':[', b']}'
+    envelope = len(prefix) + len(suffix)
+
+    index = 0
+    chunk, encoded, size = [], [], envelope
+    for entry, item in iter_encoded(entries, dumps):
+        item_size = len(item) + (1 if encoded else 0)  # separator
+
+        full = chunk_size is not None and len(chunk) >= chunk_size
+        too_big = max_chunk_bytes is not None and size + item_size > max_chunk_bytes
+        if chunk and (full or too_big):
+            yield index, chunk, prefix + b','.join(encoded) + suffix
+            index += 1
+            chunk, encoded, size = [], [], envelope
+            item_size = len(item)
+
+        chunk.append(entry)
+        encoded.append(item)
+        size += item_size
+
+    if chunk:
+        yield index, chunk, prefix + b','.join(encoded) + suffix
+
+
+def iter_json_body(doc, key, items, buffer_size=64 * 1024, codec=None):
+    """
+    Encodes `doc`, with `doc[key]` set to the list of `items`, as JSON piece
+    by piece. `items` can be any iterable and is consumed lazily, encoding
+    a slice of items at a time (see `iter_encoded_slices()`), so that the
+    document never has to be in memory as a whole.
+
+    Yields UTF-8 encoded chunks of about `buffer_size` bytes.
+    """
+    dumps = (codec or default_codec).dumps
+    head = dict((k, v) for k, v in doc.items() if k != key)
+    head = dumps(head)[:-1] + b',' if head else b'{'
+
+    pieces = [head, dumps(key), b':[']
+    size = 0
+    separator = b''
+    for piece in iter_encoded_slices(items, dumps):
+        pieces.append(separator)
+        pieces.append(piece)
+        size += len(piece)
+        separator = b','
+        if size >= buffer_size:
+            yield b''.join(pieces)
+            pieces, size = [], 0
+    pieces.append(b']}')
+    yield b''.join(pieces)
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_gzip(chunks, level=6):
+    """Gzip compresses a stream of bytes `chunks`, yielding compressed chunks."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def is_replayable(body):
+    """Whether a request `body` can be sent again, i.e. is not a stream."""
+    return body is None or isinstance(body, (six.binary_type, six.text_type))
+
+
+class JSONArrayParser(object):
+    """
+    Incremental parser that picks the items of the array at `key` out of a
+    JSON object, while the object's text is fed to it piece by piece. All
+    other members of the object are skipped.
+
+        parser = JSONArrayParser('data')
+        for text in pieces:
+            for item in parser.feed(text):
+                ...
+        parser.close()
+    """
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, key):
+        self.key = key
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._value = None
+
+    def feed(self, text):
+        """Adds the next piece of text, returning the list of items it completed."""
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+        items = []
+        while True:
+            char = self._peek()
+            if char is None:
+                return items
+
+            state = self._state
+            if state == 'start':
+                self._expect(char, '{')
+                self._state = 'first_member'
+            elif state == 'first_member' and char == '}':
+                self._pos += 1
+                self._state = 'done'
+            elif state in ('first_member', 'member'):
+                if not self._decode():
+                    return items
+                self._state = 'colon'
+            elif state == 'colon':
+                self._expect(char, ':')
+                self._state = 'array' if self._value == self.key else 'value'
+            elif state == 'array' and char == '[':
+                self._pos += 1
+                self._state = 'first_item'
+            elif state in ('array', 'value'):
+                if not self._decode():
+                    return items
+                self._state = 'after_member'
+            elif state == 'first_item' and char == ']':
+                self._pos += 1
+                self._state = 'after_member'
+            elif state in ('first_item', 'item'):
+                if not self._decode():
+                    return items
+                items.append(self._value)
+                self._state = 'after_item'
+            elif state == 'after_item':
+                self._expect(char, ',]')
+                self._state = 'item' if char == ',' else 'after_member'
+            elif state == 'after_member':
+                self._expect(char, ',}')
+                self._state = 'member' if char == ',' else 'done'
+            else:
+                raise ValueError('Extra data after the end of the JSON document')
+
+    def close(self):
+        """Checks that the complete document has been fed."""
+        if self._state != 'done':
+            raise ValueError('Incomplete JSON document')
+
+    def _peek(self):
+        while self._pos < len(self._buf) and self._buf[self._pos] in self.WHITESPACE:
+            self._pos += 1
+        return self._buf[self._pos] if self._pos < len(self._buf) else None
+
+    def _expect(self, char, expected):
+        if char not in expected:
+            raise ValueError('Expected {0!r} at position {1}, got {2!r}'.format(expected, self._pos, char))
+        self._pos += 1
+
+    def _decode(self):
+        """Decodes the next value into `self._value`, or returns False if it's incomplete."""
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except ValueError:
+            return False
+        if end == len(self._buf):
+            # A number at the very end of the buffer may continue in the next
+            # piece. In a valid document, every value is followed by a , ] or }.
+            return False
+        self._value = value
+        self._pos = end
+        return True
+
+
+def imap_unordered(func, iterable, concurrency):
+    """
+    Calls `func` on every item of `iterable` from `concurrency` threads and
+    yields the results in completion order.
+
+    Unlike `ThreadPool.imap_unordered()`, items are only pulled from
+    `iterable` as threads become free, so arbitrarily large (lazy) inputs
+    are never materialized in memory.
+    """
+    iterator = iter(iterable)
+    lock = threading.Lock()
+    results = queue.Queue(maxsize=concurrency)
+    stop = threading.Event()
+    finished = object()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with lock:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                put((True, func(item)))
+        except Exception as e:
+            put((False, e))
+        finally:
+            put(finished)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            value = results.get()
+            if value is finished:
+                running -= 1
+                continue
+            success, result = value
+            if not success:
+                raise result
+            yield result
+    finally:
+        stop.set()
+
+
+ChunkOutcome = namedtuple('ChunkOutcome', ['index', 'size', 'entries', 'result', 'error'])
+AddressBookResult = namedtuple('AddressBookResult', ['user_id', 'result', 'error'])
+DomainEmailsResult = namedtuple('DomainEmailsResult', ['domain', 'emails', 'error'])
+
+
+class ChunkedResult(object):
+    """
+    Merged outcome of a batch endpoint call that was split into chunks.
+
+    `succeeded` and `failed` hold a `ChunkOutcome` per chunk, ordered by
+    chunk index. Successful outcomes carry the decoded API response in
+    `result`, failed ones carry the exception in `error` and keep their
+    `entries` around, so they can be resubmitted.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    def add(self, outcome):
+        if outcome.error is None:
+            # Don't hold on to entries that made it
+            self.succeeded.append(outcome._replace(entries=None))
+        else:
+            self.failed.append(outcome)
+
+    def sort(self):
+        self.succeeded.sort(key=lambda outcome: outcome.index)
+        self.failed.sort(key=lambda outcome: outcome.index)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def results(self):
+        return [outcome.result for outcome in self.succeeded]
+
+    def failed_entries(self):
+        """Returns all entries of the failed chunks, e.g. to retry them."""
+        return [entry for outcome in self.failed for entry in outcome.entries]
+
+    def raise_for_errors(self):
+        """Raises the error of the first failed chunk, if any."""
+        if self.failed:
+            raise self.failed[0].error
+
+    def __repr__(self):
+        return '<ChunkedResult: {0} succeeded, {1} failed>'.format(len(self.succeeded), len(self.failed))
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and after how long, a failed request is retried.
+
+    Requests failing with a connection error or one of `retry_statuses` are
+    retried up to `max_retries` times. The delay between attempts follows
+    "decorrelated jitter" exponential backoff between `backoff_base` and
+    `backoff_cap` seconds, unless the server asks for a specific delay with
+    a Retry-After header. No retry is scheduled that would end past
+    `deadline` seconds after the first attempt.
+
+    Only idempotent methods are retried after the request may have reached
+    the server. POSTs are retried only when that's known to be safe: when
+    the connection could not be established, or when the server answered
+    429 or 503 (i.e. it did not process the request). Pass
+    `retry_post=True` to retry POSTs like any other method.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    NOT_PROCESSED_STATUSES = (429, 503)
+
+    def __init__(self, max_retries=3, backoff_base=0.1, backoff_cap=10.0, deadline=30.0,
+                 retry_statuses=RETRY_STATUSES, retry_post=False):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.retry_post = retry_post
+
+    def is_retryable(self, method, status=None, connect_error=False):
+        """
+        Whether a request is safe to retry after it failed with `status`,
+        or with a connection error when `status` is None.
+        """
+        if status is None:
+            if connect_error:
+                return True  # never reached the server
+        elif status not in self.retry_statuses:
+            return False
+        elif status in self.NOT_PROCESSED_STATUSES:
+            return True
+
+        return method.upper() in self.IDEMPOTENT_METHODS or self.retry_post
+
+    def backoff(self, previous_delay=None):
+        previous_delay = previous_delay or self.backoff_base
+        return min(self.backoff_cap, random.uniform(self.backoff_base, previous_delay * 3))
+
+    def get_delay(self, method, retries, elapsed, previous_delay=None, status=None, headers=None,
+                  connect_error=False):
+        """
+        Returns the number of seconds to wait before the next attempt, or
+        None when the request should not be retried (anymore).
+        """
+        if retries >= self.max_retries:
+            return None
+        if not self.is_retryable(method, status=status, connect_error=connect_error):
+            return None
+
+        delay = parse_retry_after(headers.get('Retry-After')) if headers else None
+        if delay is None:
+            delay = self.backoff(previous_delay)
+
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+def parse_retry_after(value):
+    """
+    Parses the value of a Retry-After header (either a number of seconds,
+    or an HTTP date) into a number of seconds from now.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    from email.utils import mktime_tz, parsedate_tz
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+def is_connect_error(error):
+    """Whether `error` happened before the request could have been sent."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), urllib3_exceptions.NewConnectionError)
+    return False
+
+
+def is_timeout(error):
+    """Whether a request failed with `error` because it timed out."""
+    if isinstance(error, requests.Timeout):
+        return True
+    # Read timeouts while streaming a response body are reported as connection errors
+    return (isinstance(error, requests.ConnectionError) and bool(error.args)
+            and isinstance(error.args[0], urllib3_exceptions.ReadTimeoutError))
+
+
+def raise_for_timeout(error, method, endpoint):
+    """Raises a `YesGraphTimeout` from `error` when the request timed out."""
+    if is_timeout(error):
+        six.raise_from(YesGraphTimeout('{0} {1} timed out: {2}'.format(method, endpoint, error)), error)
+
+
+class YesGraphTimeout(Exception):
+    """
+    Raised when a request to the YesGraph API timed out, or when the
+    deadline of a call passed before it was done.
+    """
+
+
+class Deadline(object):
+    """
+    The point in time by which a call, including all its retries, pages
+    and chunks, has to be done, `seconds` from now. Pass the same
+    `Deadline` as `deadline` to several calls to share one budget between
+    them.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = default_timer() + seconds
+
+    @classmethod
+    def get(cls, deadline):
+        """Returns `deadline` as a `Deadline`: it may be one, a number of seconds, or None."""
+        if deadline is None or isinstance(deadline, Deadline):
+            return deadline
+        return cls(deadline)
+
+    def remaining(self):
+        return self.expires - default_timer()
+
+    def check(self, method, endpoint):
+        """Raises `YesGraphTimeout` when the deadline has passed."""
+        if self.remaining() <= 0:
+            raise YesGraphTimeout('{0} {1}: deadline of {2}s exceeded'.format(method, endpoint, self.seconds))
+
+
+DEFAULT_TIMEOUT = (10.0, 60.0)
+
+
+class Timeouts(object):
+    """
+    Connect and read timeouts per endpoint, in seconds.
+
+    `timeouts` is either the timeout for all requests, or a dict mapping
+    endpoint prefixes (e.g. '/address-book') to the timeout of requests to
+    matching endpoints. The longest matching prefix wins; the '*' timeout,
+    or `DEFAULT_TIMEOUT`, is used for all other endpoints. A timeout is a
+    number of seconds, a `(connect, read)` tuple, or None for no timeout.
+    The read timeout limits the time between bytes received, not the total
+    time a request takes; pass a `deadline` to limit that.
+    """
+
+    def __init__(self, timeouts=DEFAULT_TIMEOUT):
+        if not isinstance(timeouts, dict):
+            timeouts = {'*': timeouts}
+        self.timeouts = dict(timeouts)
+        self._prefixes = sorted((('/' + prefix.lstrip('/'), timeout) for prefix, timeout in self.timeouts.items()
+                                 if prefix != '*'), key=lambda item: len(item[0]), reverse=True)
+
+    def for_endpoint(self, endpoint, deadline=None):
+        """
+        Returns the `(connect, read)` timeouts for a request to `endpoint`,
+        either shortened to what remains of `deadline`, or None for none.
+        """
+        endpoint = '/' + endpoint.lstrip('/')
+        timeout = self.timeouts.get('*', DEFAULT_TIMEOUT)
+        for prefix, prefix_timeout in self._prefixes:
+            if endpoint.startswith(prefix):
+                timeout = prefix_timeout
+                break
+
+        if timeout is None:
+            connect = read = None
+        elif isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        if deadline is not None:
+            remaining = max(deadline.remaining(), 0.001)
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        return None if connect is None and read is None else (connect, read)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket, refilled with `rate` tokens per second and
+    holding at most `capacity` tokens (defaults to `rate`, i.e. bursts of
+    up to one second worth of requests).
+
+    Tokens are reserved up front: `reserve()` always takes the tokens and
+    returns how long the caller has to wait before using them, so waiting
+    callers are served in order without polling.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._lock = threading.Lock()
+        self._level = self.capacity
+        self._updated = time.time()
+
+    def reserve(self, tokens=1):
+        """Takes `tokens` and returns the number of seconds to wait before using them."""
+        with self._lock:
+            return self._reserve(tokens)
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve(self, tokens):
+        now = time.time()
+        level, updated = self._load()
+        level = min(self.capacity, level + max(0.0, now - updated) * self.rate) - tokens
+        self._store(level, now)
+        return max(0.0, -level / self.rate)
+
+    def _load(self):
+        return self._level, self._updated
+
+    def _store(self, level, updated):
+        self._level, self._updated = level, updated
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    `TokenBucket` whose state lives in a small file at `path`, so all
+    processes on a host using the same path share one budget. Access is
+    serialized with `flock()`, so this is only available on POSIX systems.
+    """
+
+    _state = struct.Struct('!dd')
+
+    def __init__(self, path, rate, capacity=None):
+        import fcntl
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self._fcntl = fcntl
+        self.path = path
+        self._file = None
+        self._pid = None
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            # flock() locks are shared with forked children through the
+            # inherited file descriptor, so every process opens its own.
+            if self._pid != os.getpid():
+                self._file = open(self.path, 'a+b')
+                self._pid = os.getpid()
+
+            self._fcntl.flock(self._file, self._fcntl.LOCK_EX)
+            try:
+                return self._reserve(tokens)
+            finally:
+                self._fcntl.flock(self._file, self._fcntl.LOCK_UN)
+
+    def _load(self):
+        self._file.seek(0)
+        data = self._file.read(self._state.size)
+        if len(data) < self._state.size:
+            return self.capacity, time.time()
+        return self._state.unpack(data)
+
+    def _store(self, level, updated):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(self._state.pack(level, updated))
+        self._file.flush()
+
+
+class RateLimiter(object):
+    """
+    Throttles requests per endpoint.
+
+    `limits` maps endpoint prefixes (e.g. '/address-book') to the
+    `TokenBucket` that requests to matching endpoints draw from. The
+    longest matching prefix wins; the '*' bucket, if any, is used for all
+    other endpoints.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self._prefixes = sorted((('/' + prefix.lstrip('/'), bucket) for prefix, bucket in self.limits.items()
+                                 if prefix != '*'), key=lambda item: len(item[0]), reverse=True)
+
+    def bucket_for(self, endpoint):
+        endpoint = '/' + endpoint.lstrip('/')
+        for prefix, bucket in self._prefixes:
+            if endpoint.startswith(prefix):
+                return bucket
+        return self.limits.get('*')
+
+    def reserve(self, endpoint):
+        """Returns how many seconds to wait before sending a request to `endpoint`."""
+        bucket = self.bucket_for(endpoint)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def acquire(self, endpoint):
+        """Blocks until a request to `endpoint` may be sent."""
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TTLCache(object):
+    """
+    Thread-safe in-memory cache for API responses.
+
+    Holds at most `maxsize` responses, evicting the least recently used one
+    when full, and expires responses `ttl` seconds after they were stored.
+    Responses are stored per user, so all of a user's responses can be
+    invalidated at once. Cached responses are shared between callers and
+    must not be modified.
+
+    `hits` and `misses` count lookups since the cache was created.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (user_id, key) -> (expires, value), least recently used first
+        self._keys = {}  # user_id -> set of keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, key):
+        """Returns the cached response, or None."""
+        with self._lock:
+            item = self._entries.pop((user_id, key), None)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    self._forget(user_id, key)
+                self.misses += 1
+                return None
+
+            self._entries[(user_id, key)] = item  # move to the end
+            self.hits += 1
+            return item[1]
+
+    def set(self, user_id, key, value):
+        with self._lock:
+            if self._entries.pop((user_id, key), None) is None:
+                self._keys.setdefault(user_id, set()).add(key)
+            self._entries[(user_id, key)] = (time.time() + self.ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                (old_user_id, old_key), _ = self._entries.popitem(last=False)
+                self._forget(old_user_id, old_key)
+
+    def invalidate(self, user_id):
+        """Drops all cached responses for `user_id`."""
+        with self._lock:
+            for key in self._keys.pop(user_id, ()):
+                self._entries.pop((user_id, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def _forget(self, user_id, key):
+        keys = self._keys.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[user_id]
+
+
+class SQLiteCache(TTLCache):
+    """
+    `TTLCache` stored in a SQLite file at `path`, so its responses are
+    shared by all processes on a host using the same file (and survive
+    restarts). `hits` and `misses` only count this process' lookups.
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=60):
+        super(SQLiteCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        self.path = path
+        self._db = connect_sqlite(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'user_id TEXT NOT NULL, '
+                         'key TEXT NOT NULL, '
+                         'value TEXT NOT NULL, '
+                         'expires REAL NOT NULL, '
+                         'accessed REAL NOT NULL, '
+                         'PRIMARY KEY (user_id, key))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def get(self, user_id, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, expires FROM responses WHERE user_id = ? AND key = ?',
+                                   (user_id, key)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._db.execute('DELETE FROM responses WHERE user_id = ? AND key = ?', (user_id, key))
+                self.misses += 1
+                return None
+
+            self._db.execute('UPDATE responses SET accessed = ? WHERE user_id = ? AND key = ?', (now, user_id, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, user_id, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses (user_id, key, value, expires, accessed) '
+                             'VALUES (?, ?, ?, ?, ?)', (user_id, key, json.dumps(value), now + self.ttl, now))
+            excess = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0] - self.maxsize
+            if excess > 0:
+                self._db.execute('DELETE FROM responses WHERE rowid IN '
+                                 '(SELECT rowid FROM responses ORDER BY accessed LIMIT ?)', (excess,))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._db.execute('DELETE FROM responses WHERE user_id = ?', (user_id,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into one: while a call for
+    a key is running, other callers for that key wait for its outcome
+    instead of making the call themselves.
+    """
+
+    class Call(object):
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Returns `func()`, or the result of the call for `key` that's already running."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class BloomFilter(object):
+    """
+    Set membership in constant memory: sized for `capacity` keys (bytes),
+    with a false positive rate of at most `error_rate` up to that size.
+    There are no false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64 bit halves of a single digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter(object):
+    """
+    Thread-safe, time-windowed `BloomFilter`: keys are remembered for at
+    least `window` seconds (and at most twice as long), in bounded memory.
+
+    It keeps two generations of `capacity` keys each. New keys go into the
+    current generation, which becomes the previous one (replacing the
+    oldest) once it is `window` seconds old or full.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001, window=86400):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        self._lock = threading.Lock()
+        self._previous = BloomFilter(capacity, error_rate)
+        self._current = BloomFilter(capacity, error_rate)
+        self._started = time.time()
+
+    def _rotate(self):
+        if self._current.count >= self.capacity or time.time() - self._started >= self.window:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._started = time.time()
+
+    def __contains__(self, key):
+        with self._lock:
+            self._rotate()
+            return key in self._current or key in self._previous
+
+    def add(self, key):
+        with self._lock:
+            self._rotate()
+            if key not in self._current:
+                self._current.add(key)
+
+
+def event_keys(endpoint, entry):
+    """Returns a key per (user_id, email or phone) pair reported by a batch event."""
+    if isinstance(entry, dict):
+        get = entry.get
+    else:
+        def get(field):
+            return getattr(entry, field, None)
+    identifiers = list(get('emails') or ()) + list(get('phones') or ()) + [get('email'), get('phone')]
+    user_id = six.text_type(get('user_id'))
+    return [u'\0'.join((endpoint, user_id, identifier)).encode('utf-8') for identifier in identifiers if identifier]
+
+
+class RequestTrace(object):
+    """
+    What happened during a single API request, as passed to observers.
+
+    `timings` maps each phase the request went through, in order, to the
+    seconds spent in it:
+
+    - encode: encoding the request body (unless it was streamed)
+    - prepare: compressing the body and preparing the request
+    - send: waiting for rate limits, connecting, sending the request and
+      waiting for the response headers (time to first byte), including
+      all retries
+    - read: receiving the response body
+    - decode: decoding the response
+
+    `request_bytes` is None for streamed bodies; `status` and
+    `response_bytes` are None when no response was received.
+    """
+
+    __slots__ = ('method', 'endpoint', 'status', 'retries', 'request_bytes', 'response_bytes', 'error', 'timings',
+                 '_last')
+
+    def __init__(self, method, endpoint, encode_time=None):
+        self.method = method
+        self.endpoint = endpoint
+        self.status = None
+        self.retries = 0
+        self.request_bytes = None
+        self.response_bytes = None
+        self.error = None
+        self.timings = OrderedDict()
+        if encode_time is not None:
+            self.timings['encode'] = encode_time
+        self._last = default_timer()
+
+    def mark(self, phase):
+        """Ends `phase`, which started when the previous one ended."""
+        now = default_timer()
+        self.timings[phase] = now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+    def __repr__(self):
+        return '<RequestTrace {0} {1}: {2} in {3:.1f}ms>'.format(self.method, self.endpoint, self.status,
+                                                                 self.total * 1000)
+
+
+class Histogram(object):
+    """
+    Latency histogram with logarithmic buckets, each `growth` times as wide
+    as the previous one, so percentiles are accurate to within that factor
+    while memory stays bounded.
+    """
+
+    def __init__(self, growth=1.05, minimum=1e-5):
+        self.growth = growth
+        self.minimum = minimum
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._log_growth = math.log(growth)
+        self._buckets = {}
+
+    def add(self, value):
+        index = int(math.log(max(value, self.minimum) / self.minimum) / self._log_growth)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Returns an upper bound for the `q`th percentile (0-100), or None when empty."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(self.minimum * self.growth ** (index + 1), self.max)
+        return self.max  # pragma: no cover
+
+
+def endpoint_name(trace):
+    """Groups requests by method and first path segment, e.g. 'GET /address-book'."""
+    return '{0} /{1}'.format(trace.method, trace.endpoint.strip('/').split('/')[0].split('?')[0])
+
+
+class LatencyHistograms(object):
+    """
+    Thread-safe observer that keeps a `Histogram` per endpoint for the total
+    duration of requests and for each phase. Pass it in the `observers` of
+    `YesGraphAPI`, and read it with `snapshot()`:
+
+        {'POST /address-book': {'total': {'count': 10, 'p50': 0.12, 'p95': 0.2, 'p99': 0.25, 'max': 0.25, ...},
+                                'send': {...}, ...}}
+
+    Requests are grouped by `key(trace)`, `endpoint_name()` by default.
+    Errors are counted per endpoint as `errors`.
+    """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, key=endpoint_name, growth=1.05):
+        self.key = key
+        self.growth = growth
+        self._lock = threading.Lock()
+        self._histograms = {}  # endpoint -> phase -> Histogram
+        self._errors = {}
+
+    def __call__(self, trace):
+        endpoint = self.key(trace)
+        with self._lock:
+            histograms = self._histograms.setdefault(endpoint, {})
+            for phase, seconds in list(trace.timings.items()) + [('total', trace.total)]:
+                if phase not in histograms:
+                    histograms[phase] = Histogram(self.growth)
+                histograms[phase].add(seconds)
+            if trace.error is not None:
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for endpoint, histograms in self._histograms.items():
+                phases = snapshot[endpoint] = {}
+                for phase, histogram in histograms.items():
+                    stats = phases[phase] = {'count': histogram.count, 'max': histogram.max,
+                                             'mean': histogram.sum / histogram.count}
+                    for q in self.percentiles:
+                        stats['p{0}'.format(q)] = histogram.percentile(q)
+                phases['errors'] = self._errors.get(endpoint, 0)
+            return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+
+
+_user_agent = None
+
+
+def get_user_agent():
+    """Returns the User-Agent sent by the client, which is computed once."""
+    global _user_agent
+    if _user_agent is None:
+        import platform
+        client_info = '/'.join(('python-yesgraph', __version__))
+        language_info = '/'.join((platform.python_implementation(), platform.python_version()))
+        platform_info = '/'.join((platform.system(), platform.release()))
+        _user_agent = ' '.join([client_info, language_info, platform_info])
+    return _user_agent
+
+
 class YesGraphAPI(object):
-    def __init__(self, secret_key, base_url='https://api.yesgraph.com/v0/'):
+    """
+    Client for the YesGraph API.
+
+    A single instance is safe to share between any number of threads. By
+    default all threads send their requests through one `requests.Session`,
+    whose connection pool keeps up to `pool_maxsize` connections per host
+    alive (`pool_connections` is the number of hosts to keep pools for). Set
+    `pool_maxsize` to at least the number of threads using the client, or
+    connections beyond that are discarded after every request and have to be
+    set up again. With `pool_block=True`, threads wait for a free connection
+    instead. With `session_per_thread=True`, every thread gets its own
+    session and connection pool. Pass `keep_alive=False` to close every
+    connection after its request.
+
+    Requests are prepared from headers and a URL prefix computed once per
+    client. Only sessions with headers, hooks, auth, params or cookies of
+    their own, or of a `Session` subclass, have their settings merged into
+    every request.
+
+    Requests time out according to `timeout`, connect and read timeouts
+    for all or per endpoint (see `Timeouts`). Every method also takes a
+    `deadline` (seconds, or a `Deadline`) that limits the total time of the
+    call, including retries, pages and chunks. Both raise `YesGraphTimeout`.
+
+    Pass a `TTLCache` (or `SQLiteCache`) as `address_book_cache` to cache
+    the responses of `get_address_book()`. A user's cached address books
+    are invalidated by `post_address_book()` and `delete_address_book()`.
+
+    To skip uploading an address book that is identical to the last one
+    posted for the same user and source, pass a cache as
+    `address_book_fingerprints`. It keeps a hash of every successfully
+    uploaded address book, along with the response, for the cache's `ttl`;
+    `delete_address_book()` forgets a user's hashes.
+
+    Pass a `RotatingBloomFilter` as `event_dedup` to drop entries of
+    `post_suggested_seen()` and `post_invites_sent()` whose (user, contact)
+    pairs were all reported within the filter's window.
+
+    Likewise, pass a `client_key_cache` to reuse client keys from
+    `get_client_key()` for the cache's `ttl`. Concurrent calls for the same
+    user then share a single request.
+
+    Request bodies of at least `compress_threshold` bytes are gzip
+    compressed (streamed bodies always are, as their size is unknown) when
+    it is set. Responses are always accepted gzip or deflate compressed.
+
+    Every callable in `observers` is called with a `RequestTrace` after each
+    request, e.g. a `LatencyHistograms`.
+
+    JSON is encoded and decoded by `codec`, a codec instance or name (see
+    `get_codec()`). By default the fastest installed codec is used.
+    """
+
+    def __init__(self, secret_key, base_url='https://api.yesgraph.com/v0/', retry=None, rate_limiter=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True,
+                 session_per_thread=False, address_book_cache=None, client_key_cache=None,
+                 compress_threshold=None, compress_level=6, codec=None, address_book_fingerprints=None,
+                 event_dedup=None, observers=(), timeout=DEFAULT_TIMEOUT):
         self.secret_key = secret_key
         self.base_url = base_url
-        self.session = Session()
+        self.codec = get_codec(codec) if isinstance(codec, six.string_types) else codec or default_codec
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout if isinstance(timeout, Timeouts) else Timeouts(timeout)
+        self.address_book_cache = address_book_cache
+        self.client_key_cache = client_key_cache
+        self.address_book_fingerprints = address_book_fingerprints
+        self.event_dedup = event_dedup
+        self.observers = list(observers)
+        self._request_template = None
+        self._client_key_calls = SingleFlight()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.session_per_thread = session_per_thread
+
+        self._local = threading.local()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                pool_maxsize=self.pool_maxsize,
+                                                pool_block=self.pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def session(self):
+        if not self.session_per_thread:
+            # Created on first use, so clients that are never used (or only
+            # used with a session of their own) don't pay for one
+            if self._session is None:
+                with self._session_lock:
+                    if self._session is None:
+                        self._session = self._make_session()
+            return self._session
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._make_session()
+        return session
+
+    @session.setter
+    def session(self, session):
+        if self.session_per_thread:
+            self._local.session = session
+        else:
+            self._session = session
 
     @property
     def user_agent(self):
-        client_info = '/'.join(('python-yesgraph', __version__))
-        language_info = '/'.join((platform.python_implementation(), platform.python_version()))
-        platform_info = '/'.join((platform.system(), platform.release()))
-        return ' '.join([client_info, language_info, platform_info])
+        return get_user_agent()
+
+    def _template(self):
+        """
+        Returns the parts of every request that only depend on the client's
+        settings: the URL prefix, the headers, the headers as sent by the
+        fast path of `_prepare_request()`, and the headers of the sessions
+        `_make_session()` makes. They are rebuilt whenever the secret key,
+        base URL or keep-alive setting change.
+        """
+        key = (self.secret_key, self.base_url, self.keep_alive)
+        template = self._request_template
+        if template is None or template[0] != key:
+            headers = {
+                'Accept-Encoding': 'gzip, deflate',
+                'Authorization': 'Bearer {0}'.format(self.secret_key),
+                'Content-Type': 'application/json',
+                'User-Agent': self.user_agent,
+            }
+            default_headers = requests.utils.default_headers()
+            if not self.keep_alive:
+                default_headers['Connection'] = 'close'
+            # What merging in the headers of the sessions we make would give
+            session_headers = default_headers.copy()
+            session_headers.update(headers)
+            template = self._request_template = (key, self.base_url.rstrip('/') + '/', headers, session_headers,
+                                                 default_headers)
+        return template
 
     def _build_url(self, endpoint, **url_args):
-        url = '/'.join((self.base_url.rstrip('/'), endpoint.lstrip('/')))
+        url = self._template()[1] + endpoint.lstrip('/')
 
-        clean_args = dict((k, v) for k, v in url_args.items() if v is not None)
-        if clean_args:
-            args = six.moves.urllib.parse.urlencode(clean_args)
-            url = '{0}?{1}'.format(url, args)
+        if url_args:
+            clean_args = sorted((k, v) for k, v in url_args.items() if v is not None)
+            if clean_args:
+                url = '{0}?{1}'.format(url, six.moves.urllib.parse.urlencode(clean_args))
 
         return url
 
+    def _build_headers(self):
+        return dict(self._template()[2])
+
+    def _compress_body(self, data, headers):
+        """Compresses the request body if it's large enough, updating `headers`."""
+        if self.compress_threshold is None or data is None:
+            return data
+
+        if is_replayable(data):
+            if isinstance(data, six.text_type):
+                data = data.encode('utf-8')
+            if len(data) < self.compress_threshold:
+                return data
+            data = gzip_compress(data, self.compress_level)
+        else:
+            data = iter_gzip(data, self.compress_level)
+
+        headers['Content-Encoding'] = 'gzip'
+        return data
+
     def _prepare_request(self, method, endpoint, data=None, **url_args):
         """Builds and prepares the complete request, but does not send it."""
-        headers = {
-            'Authorization': 'Bearer {0}'.format(self.secret_key),
-            'Content-Type': 'application/json',
-            'User-Agent': self.user_agent,
-        }
+        session = self.session
+        if self._is_plain_session(session):
+            return self._prepare_fast(method, endpoint, data, **url_args)
+        return self._prepare_with_session(session, method, endpoint, data, **url_args)
+
+    def _is_plain_session(self, session):
+        """
+        Whether `session` is set up like the ones `_make_session()` makes,
+        i.e. has no headers, hooks, auth, params or cookies of its own that
+        `_prepare_fast()` would leave out.
+        """
+        return (type(session) is requests.Session and session.auth is None and not session.params
+                and not session.cookies and not any(session.hooks.values())
+                and session.headers == self._template()[4])
+
+    def _prepare_with_session(self, session, method, endpoint, data=None, **url_args):
+        headers = self._build_headers()
+        data = self._compress_body(data, headers)
 
         url = self._build_url(endpoint, **url_args)
 
-        req = Request(method, url, data=data, headers=headers)
+        req = requests.Request(method, url, data=data, headers=headers)
 
-        prepped_req = self.session.prepare_request(req)
+        prepped_req = session.prepare_request(req)
 
         return prepped_req
 
-    def _request(self, method, endpoint, data=None, **url_args):  # pragma: no cover
+    def _prepare_fast(self, method, endpoint, data=None, **url_args):
         """
-        Builds, prepares, and sends the complete request to the YesGraph API,
-        returning the decoded response.
+        Prepares the request from the precomputed template, without merging
+        in the session's settings, for plain sessions made by this client.
         """
+        prepped_req = requests.PreparedRequest()
+        prepped_req.method = method.upper()
+        prepped_req.url = requests.utils.requote_uri(self._build_url(endpoint, **url_args))
+        prepped_req.headers = self._template()[3].copy()
+        prepped_req._cookies = requests.cookies.RequestsCookieJar()  # used when following redirects
+        prepped_req.prepare_body(self._compress_body(data, prepped_req.headers), None)
+        return prepped_req
 
-        prepped_req = self._prepare_request(method, endpoint, data=data, **url_args)
-        resp = self.session.send(prepped_req)
-        return self._handle_response(resp)
+    def _encode(self, obj):
+        """Encodes a request body, timing it for the next `RequestTrace` of this thread."""
+        if not self.observers:
+            return self.codec.dumps(obj)
+        started = default_timer()
+        data = self.codec.dumps(obj)
+        self._local.encode_time = (getattr(self._local, 'encode_time', None) or 0) + default_timer() - started
+        return data
+
+    def _start_trace(self, method, endpoint):
+        """Returns a new `RequestTrace`, or None when nobody's observing."""
+        if not self.observers:
+            return None
+        encode_time = getattr(self._local, 'encode_time', None)
+        self._local.encode_time = None
+        return RequestTrace(method, endpoint, encode_time)
+
+    def _notify(self, trace):
+        for observer in self.observers:
+            try:
+                observer(trace)
+            except Exception:
+                logger.exception('Observer %r failed', observer)
+
+    def _request(self, method, endpoint, data=None, deadline=None, **url_args):  # pragma: no cover
+        """
+        Builds, prepares, and sends the complete request to the YesGraph API,
+        returning the decoded response. Raises `YesGraphTimeout` when it's
+        not done by `deadline` (a `Deadline`, or seconds from now).
+        """
+        deadline = Deadline.get(deadline)
+        trace = self._start_trace(method, endpoint)
+        if trace is None:
+            prepped_req = self._prepare_request(method, endpoint, data=data, **url_args)
+            resp = self._send(prepped_req, endpoint, deadline=deadline)
+            return self._handle_response(resp)
+        return self._traced_request(trace, method, endpoint, data, deadline, **url_args)
+
+    def _traced_request(self, trace, method, endpoint, data=None, deadline=None, **url_args):
+        try:
+            prepped_req = self._prepare_request(method, endpoint, data=data, **url_args)
+            if is_replayable(prepped_req.body):
+                trace.request_bytes = len(prepped_req.body or b'')
+            trace.mark('prepare')
+
+            # Streaming, so that the response body is read separately
+            resp = self._send(prepped_req, endpoint, stream=True, trace=trace, deadline=deadline)
+            trace.status = resp.status_code
+            trace.mark('send')
+            try:
+                trace.response_bytes = len(resp.content)
+            except requests.RequestException as e:
+                raise_for_timeout(e, method, endpoint)
+                raise
+            trace.mark('read')
+            result = self._handle_response(resp)
+            trace.mark('decode')
+            return result
+        except Exception as e:
+            trace.error = e
+            raise
+        finally:
+            self._notify(trace)
+
+    def _send(self, prepped_req, endpoint, stream=False, trace=None, deadline=None):
+        """
+        Sends the prepared request with the timeouts of `self.timeout`,
+        throttled by `self.rate_limiter` and retried according to
+        `self.retry`, all within `deadline`. Raises `YesGraphTimeout` when
+        the request timed out. The number of retries is recorded in `trace`,
+        if given.
+        """
+        method = prepped_req.method
+        retry = self.retry if is_replayable(prepped_req.body) else None
+        started = time.time()
+        retries = 0
+        delay = None
+        while True:
+            wait = self._throttle(method, endpoint, deadline)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                resp = self.session.send(prepped_req, stream=stream,
+                                         timeout=self.timeout.for_endpoint(endpoint, deadline))
+            except requests.RequestException as e:
+                delay = self._retry_delay(retry, method, retries, started, delay, deadline,
+                                          connect_error=is_connect_error(e))
+                if delay is None:
+                    raise_for_timeout(e, method, endpoint)
+                    raise
+            else:
+                delay = self._retry_delay(retry, method, retries, started, delay, deadline,
+                                          status=resp.status_code, headers=resp.headers)
+                if delay is None:
+                    return resp
+                resp.close()
+
+            retries += 1
+            if trace is not None:
+                trace.retries = retries
+            time.sleep(delay)
+
+    def _throttle(self, method, endpoint, deadline=None):
+        """
+        Returns how many seconds to wait for `self.rate_limiter` before
+        sending a request, or raises `YesGraphTimeout` when that would take
+        past `deadline`.
+        """
+        wait = self.rate_limiter.reserve(endpoint) if self.rate_limiter is not None else 0.0
+        if deadline is not None:
+            deadline.check(method, endpoint)
+            if wait >= deadline.remaining():
+                raise YesGraphTimeout('{0} {1}: rate limited past the deadline of {2}s'.format(
+                    method, endpoint, deadline.seconds))
+        return wait
+
+    def _retry_delay(self, retry, method, retries, started, previous_delay, deadline, **outcome):
+        """
+        Returns the delay before retrying a request that started at
+        `started`, or None when it's not to be retried (in time for
+        `deadline`).
+        """
+        if retry is None:
+            return None
+        delay = retry.get_delay(method, retries, time.time() - started, previous_delay, **outcome)
+        if delay is not None and deadline is not None and delay >= deadline.remaining():
+            return None
+        return delay
 
     def _handle_response(self, response):
         """Decodes the HTTP response when successful, or throws an error."""
         response.raise_for_status()
-        return response.json()
+        return self.codec.loads(response.content)
 
-    def test(self):
+    def _iter_items(self, key, method, endpoint, chunk_size=16 * 1024, deadline=None, **url_args):
+        """
+        Sends the request, and yields the items of the `key` array in the
+        response as soon as they have been received and decoded.
+        """
+        deadline = Deadline.get(deadline)
+        trace = self._start_trace(method, endpoint)
+        response = None
+        try:
+            prepped_req = self._prepare_request(method, endpoint, **url_args)
+            if trace is not None:
+                trace.mark('prepare')
+            response = self._send(prepped_req, endpoint, stream=True, trace=trace, deadline=deadline)
+            if trace is not None:
+                trace.status = response.status_code
+                trace.response_bytes = 0
+                trace.mark('send')
+            response.raise_for_status()
+            parser = JSONArrayParser(key)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    if trace is not None:
+                        trace.response_bytes += len(chunk)
+                    for item in parser.feed(decoder.decode(chunk)):
+                        yield item
+                    if deadline is not None:
+                        deadline.check(method, endpoint)
+            except requests.RequestException as e:
+                raise_for_timeout(e, method, endpoint)
+                raise
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+            if trace is not None:
+                trace.mark('read')  # and decode, which is interleaved
+        except Exception as e:
+            if trace is not None:
+                trace.error = e
+            raise
+        finally:
+            if response is not None:
+                response.close()
+            if trace is not None:
+                self._notify(trace)
+
+    def _post_entries(self, endpoint, key, entries, chunk_size=None, max_chunk_bytes=None, concurrency=1,
+                      deadline=None, doc=None):
+        """
+        POSTs `{key: entries}`, plus the other keys of `doc`, to a batch
+        endpoint. When `chunk_size` or `max_chunk_bytes` is given, the
+        entries are split up and sent as several requests (each with the
+        other keys of `doc`), all within `deadline`, and a `ChunkedResult`
+        is returned instead.
+        """
+        if chunk_size is None and max_chunk_bytes is None:
+            if key is not None and has_records(entries):
+                data = b''.join(iter_json_body(doc or {}, key, entries, codec=self.codec))
+            else:
+                data = self._encode(entries if key is None else dict(doc or {}, **{key: entries}))
+            return self._request('POST', endpoint, data=data, deadline=deadline)
+
+        chunks = iter_chunks(entries, key=key, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                             codec=self.codec, doc=doc)
+        return self._post_chunks(endpoint, chunks, concurrency=concurrency, deadline=deadline)
+
+    def _post_chunks(self, endpoint, chunks, concurrency=1, deadline=None):
+        deadline = Deadline.get(deadline)
+
+        def send(chunk):
+            index, entries, body = chunk
+            try:
+                result = self._request('POST', endpoint, data=body, deadline=deadline)
+                return ChunkOutcome(index, len(entries), entries, result, None)
+            except (requests.RequestException, YesGraphTimeout) as e:
+                return ChunkOutcome(index, len(entries), entries, None, e)
+
+        result = ChunkedResult()
+        if concurrency > 1:
+            outcomes = imap_unordered(send, chunks, concurrency)
+        else:
+            outcomes = six.moves.map(send, chunks)
+        for outcome in outcomes:
+            result.add(outcome)
+        result.sort()
+        return result
+
+    def _cached_get(self, cache, user_id, endpoint, deadline=None, **url_args):
+        """GETs `endpoint`, going through `cache` for `user_id`'s responses."""
+        key = self._build_url(endpoint, **url_args)
+        result = cache.get(user_id, key)
+        if result is None:
+            result = self._request('GET', endpoint, deadline=deadline, **url_args)
+            cache.set(user_id, key, result)
+        return result
+
+    def _dedup_events(self, endpoint, entries):
+        """Drops entries whose (user, contact) pairs were all reported before."""
+        if self.event_dedup is None:
+            return entries
+
+        fresh, seen, dropped = [], set(), 0
+        for entry in entries:
+            keys = event_keys(endpoint, entry)
+            if keys and all(key in seen or key in self.event_dedup for key in keys):
+                dropped += 1
+                continue
+            seen.update(keys)
+            fresh.append(entry)
+        if dropped:
+            logger.debug('Dropped %d repeated %s entries', dropped, endpoint)
+        return fresh
+
+    def _events_reported(self, endpoint, entries, result):
+        """Remembers the successfully reported `entries` in `self.event_dedup`."""
+        if self.event_dedup is not None:
+            if isinstance(result, ChunkedResult):
+                failed = set(id(entry) for entry in result.failed_entries())
+                entries = [entry for entry in entries if id(entry) not in failed]
+            for entry in entries:
+                for key in event_keys(endpoint, entry):
+                    self.event_dedup.add(key)
+        return result
+
+    def _result(self, value):
+        """Returns `value` from a public method without making a request."""
+        self._local.encode_time = None  # so a body encoded for nothing doesn't show up in the next trace
+        return value
+
+    def _address_book_changed(self, user_id, result, fingerprint=None):
+        """
+        Invalidates cached address books of `user_id` after `result` was
+        received, and records the `(source, hash)` fingerprint of a posted
+        address book along with `result` (or forgets all of them, when there
+        is none).
+        """
+        if self.address_book_cache is not None:
+            self.address_book_cache.invalidate(str(user_id))
+        if self.address_book_fingerprints is not None:
+            if fingerprint is None:
+                self.address_book_fingerprints.invalidate(str(user_id))
+            else:
+                source, digest = fingerprint
+                self.address_book_fingerprints.set(str(user_id), source, [digest, result])
+        return result
+
+    def test(self, deadline=None):
         """
         Wrapped method for GET of /test endpoint
 
         Documentation - https://docs.yesgraph.com/docs/test
         """
-        return self._request('GET', '/test')
+        return self._request('GET', '/test', deadline=deadline)
 
-    def _get_client_key(self, user_id):
-        data = json.dumps({'user_id': str(user_id)})
-        return self._request('POST', '/client-key', data)
+    def _get_client_key(self, user_id, deadline=None):
+        data = self._encode({'user_id': str(user_id)})
+        return self._request('POST', '/client-key', data, deadline=deadline)
 
-    def get_client_key(self, user_id):
+    def get_client_key(self, user_id, deadline=None):
         """
         Wrapped method for POST of /client-key endpoint
 
         Documentation - https://docs.yesgraph.com/docs/create-client-keys
         """
-        result = self._get_client_key(user_id)
+        if self.client_key_cache is None:
+            result = self._get_client_key(user_id, deadline)
+            return result['client_key']
+
+        user_id = str(user_id)
+        client_key = self.client_key_cache.get(user_id, 'client_key')
+        if client_key is None:
+            # Concurrent callers share the request, and the deadline, of the first one
+            client_key = self._client_key_calls.do(user_id, lambda: self._mint_client_key(user_id, deadline))
+        return client_key
+
+    def _mint_client_key(self, user_id, deadline=None):
+        result = self._get_client_key(user_id, deadline)
+        self.client_key_cache.set(user_id, 'client_key', result['client_key'])
         return result['client_key']
 
+    def prewarm_client_keys(self, user_ids, concurrency=10, deadline=None):
+        """
+        Fills the client key cache for all `user_ids`, `concurrency` at a
+        time. Returns a dict with the error for every user whose key could
+        not be created.
+        """
+        if self.client_key_cache is None:
+            raise ValueError('Prewarming client keys requires a client_key_cache')
+        deadline = Deadline.get(deadline)
+
+        def warm(user_id):
+            try:
+                self.get_client_key(user_id, deadline)
+            except (requests.RequestException, YesGraphTimeout) as e:
+                return str(user_id), e
+
+        return dict(failure for failure in imap_unordered(warm, user_ids, concurrency) if failure is not None)
+
     def post_address_book(self, user_id, entries, source_type, source_name=None,
                           source_email=None, filter_suggested_seen=None,
                           filter_existing_users=None,
@@ -112,11 +2060,33 @@ class YesGraphAPI(object):
                           promote_existing_users=None,
                           promote_matching_domain=None,
                           backfill=None,
-                          limit=None):
+                          limit=None,
+                          normalize=False,
+                          default_country_code=None,
+                          deadline=None):
         """
         Wrapped method for POST of /address-book endpoint
 
         Documentation - https://docs.yesgraph.com/docs/address-book
+
+        `entries` can be any iterable, e.g. a generator reading contacts from
+        a file or database. Unless it's a list, the request body is encoded
+        and streamed (with chunked transfer encoding) as the entries are
+        consumed, so they never all have to be in memory. Streamed requests
+        are not retried.
+
+        Entries may also be `Contact` records, or an `AddressBookBatch`,
+        which is validated once and then encoded straight from its columns,
+        a slice of contacts at a time.
+
+        Pass `normalize=True` to clean up and merge duplicate entries first
+        (see `normalize_contacts()`); the entries are then collected in
+        memory rather than streamed.
+
+        With `address_book_fingerprints` set, the body is always built in
+        memory to be hashed. When the same body was uploaded for this user
+        and source before, nothing is sent and the response to that upload
+        is returned again.
         """
         source = {
             'type': source_type,
@@ -126,6 +2096,13 @@ class YesGraphAPI(object):
         if source_email:
             source['email'] = source_email
 
+        if normalize:
+            entries, removed = normalize_contacts(entries, default_country_code)
+            logger.info('Removed %d duplicate address book entries of user %s', removed, user_id)
+
+        if self.address_book_fingerprints is not None and not isinstance(entries, (list, tuple, AddressBookBatch)):
+            entries = list(entries)  # to be hashed as a whole
+
         if limit is not None:
             assert(type(limit) == int)
 
@@ -146,9 +2123,27 @@ class YesGraphAPI(object):
             'backfill': backfill
         }
 
-        data = json.dumps(data)
+        if isinstance(entries, AddressBookBatch):
+            entries.validate()
+            data = b''.join(iter_json_body(data, 'entries', entries, codec=self.codec))
+        elif isinstance(entries, (list, tuple)):
+            if has_records(entries):
+                data = b''.join(iter_json_body(data, 'entries', entries, codec=self.codec))
+            else:
+                data = self._encode(data)
+        else:
+            data = iter_json_body(data, 'entries', entries, codec=self.codec)
+
+        fingerprint = None
+        if self.address_book_fingerprints is not None:
+            fingerprint = (self.codec.dumps(source).decode('utf-8'), hashlib.sha1(data).hexdigest())
+            uploaded = self.address_book_fingerprints.get(str(user_id), fingerprint[0])  # [hash, response]
+            if uploaded is not None and uploaded[0] == fingerprint[1]:
+                logger.debug('Skipping unchanged address book of user %s', user_id)
+                return self._result(uploaded[1])
 
-        return self._request('POST', '/address-book', data)
+        return self._address_book_changed(user_id, self._request('POST', '/address-book', data, deadline=deadline),
+                                          fingerprint)
 
     def get_address_book(self, user_id, filter_suggested_seen=None,
                          filter_existing_users=None,
@@ -156,7 +2151,8 @@ class YesGraphAPI(object):
                          promote_existing_users=None,
                          promote_matching_domain=None,
                          filter_blank_names=None,
-                         limit=None):
+                         limit=None,
+                         deadline=None):
         """
         Wrapped method for GET of /address-book endpoint
 
@@ -171,36 +2167,86 @@ class YesGraphAPI(object):
                    'promote_matching_domain': promote_matching_domain,
                    'limit': limit}
 
-        endpoint = '/address-book/{0}'.format(quote_plus(str(user_id)))
-        return self._request('GET', endpoint, **urlargs)
+        endpoint = '/address-book/{0}'.format(urllib_parse.quote_plus(str(user_id)))
+        if self.address_book_cache is not None:
+            return self._cached_get(self.address_book_cache, str(user_id), endpoint, deadline=deadline, **urlargs)
+        return self._request('GET', endpoint, deadline=deadline, **urlargs)
+
+    def iter_address_book(self, user_id, filter_suggested_seen=None,
+                          filter_existing_users=None,
+                          filter_invites_sent=None,
+                          promote_existing_users=None,
+                          promote_matching_domain=None,
+                          filter_blank_names=None,
+                          limit=None,
+                          deadline=None):
+        """
+        Streaming version of `get_address_book()`: yields the ranked contacts
+        one by one, as soon as they have been received. Only the contact
+        being decoded is held in memory, and stopping the iteration early
+        closes the connection.
+        """
+
+        urlargs = {'filter_suggested_seen': filter_suggested_seen,
+                   'filter_existing_users': filter_existing_users,
+                   'filter_invites_sent': filter_invites_sent,
+                   'filter_blank_names': filter_blank_names,
+                   'promote_existing_users': promote_existing_users,
+                   'promote_matching_domain': promote_matching_domain,
+                   'limit': limit}
+
+        endpoint = '/address-book/{0}'.format(urllib_parse.quote_plus(str(user_id)))
+        return self._iter_items('data', 'GET', endpoint, deadline=deadline, **urlargs)
 
-    def delete_address_book(self, user_id):
+    def get_address_books(self, user_ids, concurrency=10, deadline=None, **filters):
+        """
+        Fetches the address books of many users, `concurrency` at a time.
+        Takes the same filters as `get_address_book()`.
+
+        Yields an `AddressBookResult(user_id, result, error)` per user in the
+        order the requests complete. A failing request does not abort the
+        others; its exception is reported in `error` instead. To actually
+        keep `concurrency` requests in flight, make sure `pool_maxsize` is at
+        least as large. `deadline` applies to all requests together.
+        """
+        deadline = Deadline.get(deadline)
+
+        def fetch(user_id):
+            try:
+                return AddressBookResult(user_id, self.get_address_book(user_id, deadline=deadline, **filters), None)
+            except (requests.RequestException, YesGraphTimeout) as e:
+                return AddressBookResult(user_id, None, e)
+
+        return imap_unordered(fetch, user_ids, concurrency)
+
+    def delete_address_book(self, user_id, deadline=None):
         """
         Wrapped method for DELETE /address-book/:user_id endpoint
 
         Documentation - https://docs.yesgraph.com/docs/address-book#section-delete-address-bookuser_id
         """
 
-        endpoint = '/address-book/{0}'.format(quote_plus(str(user_id)))
-        return self._request('DELETE', endpoint)
+        endpoint = '/address-book/{0}'.format(urllib_parse.quote_plus(str(user_id)))
+        return self._address_book_changed(user_id, self._request('DELETE', endpoint, deadline=deadline))
 
     def post_invites_accepted(self, **kwargs):
         """
         Wrapped method for POST of /invites-accepted endpoint
 
         Documentation - https://docs.yesgraph.com/docs/invites-accepted
+
+        Pass `chunk_size` and/or `max_chunk_bytes` to split large entry lists
+        over several requests (`concurrency` of them at a time), in which
+        case a `ChunkedResult` is returned.
         """
 
         entries = kwargs.get('entries', None)
 
-        if entries and type(entries) == list:
-            data = {'entries': entries}
-        else:
+        if not (entries and type(entries) == list):
             raise ValueError('An entry list is required')
 
-        data = json.dumps(data)
-
-        return self._request('POST', '/invites-accepted', data)
+        return self._post_entries('/invites-accepted', 'entries', entries, deadline=kwargs.get('deadline'),
+                                  **_chunk_options(kwargs))
 
     def post_invite_accepted(self, **kwargs):
         """
@@ -243,25 +2289,31 @@ class YesGraphAPI(object):
 
         entries = {'entries': [data]}
 
-        return self.post_invites_accepted(**entries)
+        return self.post_invites_accepted(deadline=kwargs.get('deadline'), **entries)
 
     def post_invites_sent(self, **kwargs):
         """
         Wrapped method for POST of /invites-sent endpoint
 
         Documentation - https://docs.yesgraph.com/docs/invites-sent
+
+        Entries may be dicts or `InviteEvent` records. Pass `chunk_size`
+        and/or `max_chunk_bytes` to split large entry lists over several
+        requests (`concurrency` of them at a time), in which case a
+        `ChunkedResult` is returned.
         """
 
         entries = kwargs.get('entries', None)
 
-        if entries:
-            data = {'entries': entries}
-        else:
+        if not entries:
             raise ValueError('An entry list is required')
 
-        data = json.dumps(data)
-
-        return self._request('POST', '/invites-sent', data=data)
+        entries = self._dedup_events('/invites-sent', entries)
+        if not entries:
+            return self._result(None)
+        return self._events_reported('/invites-sent', entries,
+                                     self._post_entries('/invites-sent', 'entries', entries,
+                                                        deadline=kwargs.get('deadline'), **_chunk_options(kwargs)))
 
     def post_invite_sent(self, user_id, **kwargs):
         """
@@ -304,56 +2356,71 @@ class YesGraphAPI(object):
 
         entries = {'entries': [data]}
 
-        return self.post_invites_sent(**entries)
+        return self.post_invites_sent(deadline=kwargs.get('deadline'), **entries)
 
     def post_suggested_seen(self, **kwargs):
         """
         Wrapped method for POST of /suggested-seen endpoint
 
         Documentation - https://docs.yesgraph.com/docs/suggested-seen
+
+        Pass `chunk_size` and/or `max_chunk_bytes` to split large entry lists
+        over several requests (`concurrency` of them at a time), in which
+        case a `ChunkedResult` is returned.
         """
 
         entries = kwargs.get('entries', None)
 
-        if entries:
-            data = {'entries': entries}
-        else:
+        if not entries:
             raise ValueError('An entry list is required')
 
-        data = json.dumps(data)
-
-        return self._request('POST', '/suggested-seen', data=data)
+        entries = self._dedup_events('/suggested-seen', entries)
+        if not entries:
+            return self._result(None)
+        return self._events_reported('/suggested-seen', entries,
+                                     self._post_entries('/suggested-seen', 'entries', entries,
+                                                        deadline=kwargs.get('deadline'), **_chunk_options(kwargs)))
 
-    def post_users(self, users):
+    def post_users(self, users, **kwargs):
         """
         Wrapped method for POST of users endpoint
 
         Documentation - https://docs.yesgraph.com/docs/users
+
+        Pass `chunk_size` and/or `max_chunk_bytes` to split large entry lists
+        over several requests (`concurrency` of them at a time), in which
+        case a `ChunkedResult` is returned.
         """
 
-        data = json.dumps(users)
+        options = _chunk_options(kwargs)
+        deadline = kwargs.get('deadline')
+        if not options:
+            return self._request('POST', '/users', data=self._encode(users), deadline=deadline)
 
-        return self._request('POST', '/users', data=data)
+        if isinstance(users, dict):  # the other keys go into every chunk
+            return self._post_entries('/users', 'entries', users['entries'], deadline=deadline, doc=users,
+                                      **options)
+        return self._post_entries('/users', None, users, deadline=deadline, **options)
 
     def post_alias(self, **kwargs):
         """
         Wrapped method for POST of /alias endpoint
 
         Documentation - https://docs.yesgraph.com/docs/alias
+
+        Pass `chunk_size` and/or `max_chunk_bytes` to split large entry lists
+        over several requests (`concurrency` of them at a time), in which
+        case a `ChunkedResult` is returned.
         """
 
         emails = kwargs.get('emails', None)
 
-        if emails and type(emails) == list:
-            data = {'emails': emails}
-        else:
+        if not (emails and type(emails) == list):
             raise ValueError('An entry list is required')
 
-        data = json.dumps(data)
-
-        return self._request('POST', '/alias', data)
+        return self._post_entries('/alias', 'emails', emails, deadline=kwargs.get('deadline'), **_chunk_options(kwargs))
 
-    def get_domain_emails(self, domain, page=None, batch_size=None):
+    def get_domain_emails(self, domain, page=None, batch_size=None, deadline=None):
         """
         Wrapped method for GET of /domain-emails/<domain> endpoint
 
@@ -362,5 +2429,328 @@ class YesGraphAPI(object):
 
         urlargs = {'page': page, 'batch_size': batch_size}
 
-        endpoint = '/domain-emails/{0}'.format(quote_plus(str(domain)))
-        return self._request('GET', endpoint, **urlargs)
+        endpoint = '/domain-emails/{0}'.format(urllib_parse.quote_plus(str(domain)))
+        return self._request('GET', endpoint, deadline=deadline, **urlargs)
+
+    def iter_domain_emails(self, domain, batch_size=100, prefetch=2, start_page=1, deadline=None):
+        """
+        Yields all emails of `domain`, walking through the pages of
+        `get_domain_emails()` until a page comes back short or empty.
+
+        While the caller works through a page, the next `prefetch` pages are
+        already being fetched in the background. `deadline` applies to all
+        pages together.
+        """
+        deadline = Deadline.get(deadline)
+
+        def fetch(page):
+            return self.get_domain_emails(domain, page=page, batch_size=batch_size, deadline=deadline).get('data') or []
+
+        def is_last(emails):
+            return not emails or (batch_size is not None and len(emails) < batch_size)
+
+        if not prefetch:
+            page = start_page
+            while True:
+                emails = fetch(page)
+                for email in emails:
+                    yield email
+                if is_last(emails):
+                    return
+                page += 1
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(prefetch + 1)
+        try:
+            pending = deque(pool.apply_async(fetch, (page,)) for page in range(start_page, start_page + prefetch + 1))
+            page = start_page + prefetch + 1
+            while True:
+                emails = pending.popleft().get()
+                for email in emails:
+                    yield email
+                if is_last(emails):
+                    return
+                pending.append(pool.apply_async(fetch, (page,)))
+                page += 1
+        finally:
+            pool.terminate()
+
+    def get_domains_emails(self, domains, batch_size=100, concurrency=10, deadline=None):
+        """
+        Fetches all emails of many domains, crawling `concurrency` domains
+        at a time.
+
+        Yields a `DomainEmailsResult(domain, emails, error)` per domain in
+        the order the domains complete. A failing domain does not abort the
+        others; its exception is reported in `error` instead. `deadline`
+        applies to all domains together.
+        """
+        deadline = Deadline.get(deadline)
+
+        def crawl(domain):
+            try:
+                emails = list(self.iter_domain_emails(domain, batch_size, prefetch=0, deadline=deadline))
+                return DomainEmailsResult(domain, emails, None)
+            except (requests.RequestException, YesGraphTimeout) as e:
+                return DomainEmailsResult(domain, None, e)
+
+        return imap_unordered(crawl, domains, concurrency)
+
+
+def format_event_date(entry, date_field):
+    """Returns a copy of a dict `entry` with a datetime `date_field` formatted; records format their own."""
+    if isinstance(entry, dict) and isinstance(entry.get(date_field), datetime):
+        entry = dict(entry)
+        entry[date_field] = format_date(entry[date_field])
+    return entry
+
+
+def _close_event_buffer(ref):
+    buffer = ref()
+    if buffer is not None:
+        buffer.close()
+
+
+class YesGraphEventBuffer(object):
+    """
+    Collects single invite and suggestion events and sends them in batches
+    to the /invites-sent, /invites-accepted and /suggested-seen endpoints
+    from a background thread.
+
+    A batch is sent as soon as `max_batch_size` events for an endpoint are
+    waiting, or at least every `flush_interval` seconds. At most `max_size`
+    events are held in memory: when the buffer is full, `add_*()` calls
+    block (or raise `queue.Full` after `timeout` seconds, or immediately
+    with `block=False`). Pending events are flushed on `close()`, which is
+    also called at interpreter exit.
+
+    Batches that fail to send, for whatever reason, are passed to
+    `on_error(error, endpoint, entries)` when given, and logged otherwise.
+    """
+
+    ENDPOINTS = {
+        '/invites-sent': ('post_invites_sent', 'sent_at'),
+        '/invites-accepted': ('post_invites_accepted', 'accepted_at'),
+        '/suggested-seen': ('post_suggested_seen', 'seen_at'),
+    }
+
+    def __init__(self, api, max_batch_size=500, flush_interval=5.0, max_size=10000, on_error=None):
+        self.api = api
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._wakeup = threading.Event()
+        self._send_lock = threading.Lock()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='yesgraph-event-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+        # Only a weak reference, so that closed buffers can be collected
+        self._atexit = functools.partial(_close_event_buffer, weakref.ref(self))
+        atexit.register(self._atexit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def add(self, endpoint, entry, block=True, timeout=None):
+        """Queues a single `entry` for the given batch endpoint."""
+        if endpoint not in self.ENDPOINTS:
+            raise ValueError('Unknown batch endpoint: {0}'.format(endpoint))
+        if self._closed:
+            raise ValueError('Cannot add events to a closed buffer')
+
+        entry = format_event_date(entry, self.ENDPOINTS[endpoint][1])
+        self._queue.put((endpoint, entry), block, timeout)
+        if self._closed:  # closed meanwhile, maybe after its last flush
+            self.flush()
+        elif self._queue.qsize() >= self.max_batch_size:
+            self._wakeup.set()
+
+    def add_invite_sent(self, entry, block=True, timeout=None):
+        self.add('/invites-sent', entry, block=block, timeout=timeout)
+
+    def add_invite_accepted(self, entry, block=True, timeout=None):
+        self.add('/invites-accepted', entry, block=block, timeout=timeout)
+
+    def add_suggested_seen(self, entry, block=True, timeout=None):
+        self.add('/suggested-seen', entry, block=block, timeout=timeout)
+
+    def flush(self):
+        """Sends all queued events, blocking until done."""
+        with self._send_lock:
+            batches = dict((endpoint, []) for endpoint in self.ENDPOINTS)
+            while True:
+                try:
+                    endpoint, entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch = batches[endpoint]
+                batch.append(entry)
+                if len(batch) >= self.max_batch_size:
+                    self._send(endpoint, batch)
+                    batches[endpoint] = []
+
+            for endpoint, batch in batches.items():
+                if batch:
+                    self._send(endpoint, batch)
+
+    def close(self):
+        """Stops the background thread and flushes all pending events."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        if hasattr(atexit, 'unregister'):  # Python 3
+            atexit.unregister(self._atexit)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _send(self, endpoint, entries):
+        # Any error is reported rather than raised, so that the background thread keeps running
+        method = getattr(self.api, self.ENDPOINTS[endpoint][0])
+        try:
+            method(entries=entries)
+        except Exception as e:
+            if self.on_error is None:
+                logger.exception('Failed to send %d events to %s', len(entries), endpoint)
+                return
+            try:
+                self.on_error(e, endpoint, entries)
+            except Exception:
+                logger.exception('Error handler %r failed', self.on_error)
+
+
+class YesGraphOutbox(object):
+    """
+    Durable on-disk outbox for the batch event endpoints (/invites-sent,
+    /invites-accepted and /suggested-seen), backed by a SQLite file.
+
+    `add_*()` only appends the events to the outbox, which is cheap enough
+    for the hot path and survives crashes. `flush()` replays everything
+    that is pending in batches of `batch_size`, and deletes events only
+    once the API has accepted them, so delivery is at-least-once. Events
+    are stored under a digest of their content, so adding the same event
+    twice (e.g. when re-running a job after a crash) stores it only once.
+
+    Space freed by delivered events is given back to the filesystem by
+    `compact()`, which runs automatically whenever the outbox is drained.
+    """
+
+    ENDPOINTS = {
+        '/invites-sent': 'sent_at',
+        '/invites-accepted': 'accepted_at',
+        '/suggested-seen': 'seen_at',
+    }
+
+    def __init__(self, api, path, batch_size=1000):
+        self.api = api
+        self.path = path
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._db = connect_sqlite(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS events ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'endpoint TEXT NOT NULL, '
+                         'digest TEXT NOT NULL UNIQUE, '
+                         'entry TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def add(self, endpoint, entries):
+        """
+        Appends `entries` (dicts or records) for the given batch endpoint to
+        the outbox.
+        """
+        if endpoint not in self.ENDPOINTS:
+            raise ValueError('Unknown batch endpoint: {0}'.format(endpoint))
+
+        date_field = self.ENDPOINTS[endpoint]
+        rows = []
+        for entry in entries:
+            if isinstance(entry, Record):
+                entry = entry.to_dict()
+            encoded = json.dumps(format_event_date(entry, date_field), sort_keys=True)
+            digest = hashlib.sha1('{0} {1}'.format(endpoint, encoded).encode('utf-8')).hexdigest()
+            rows.append((endpoint, digest, encoded))
+
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('INSERT OR IGNORE INTO events (endpoint, digest, entry) VALUES (?, ?, ?)', rows)
+            self._db.execute('COMMIT')
+
+    def add_invites_sent(self, entries):
+        self.add('/invites-sent', entries)
+
+    def add_invites_accepted(self, entries):
+        self.add('/invites-accepted', entries)
+
+    def add_suggested_seen(self, entries):
+        self.add('/suggested-seen', entries)
+
+    def flush(self, deadline=None):
+        """
+        Sends all pending events and returns how many were delivered.
+
+        Stops at the first batch that fails and raises its error; the
+        undelivered events stay in the outbox for the next `flush()`.
+        `deadline` applies to all batches together.
+        """
+        deadline = Deadline.get(deadline)
+        delivered = 0
+        with self._flush_lock:
+            for endpoint in sorted(self.ENDPOINTS):
+                while True:
+                    with self._lock:
+                        rows = self._db.execute('SELECT id, entry FROM events WHERE endpoint = ? '
+                                                'ORDER BY id LIMIT ?', (endpoint, self.batch_size)).fetchall()
+                    if not rows:
+                        break
+
+                    # Stored entries are JSON already, no need to decode them again
+                    body = '{{"entries": [{0}]}}'.format(', '.join(entry for _, entry in rows)).encode('utf-8')
+                    self.api._request('POST', endpoint, data=body, deadline=deadline)
+
+                    with self._lock:
+                        self._db.execute('BEGIN')
+                        self._db.executemany('DELETE FROM events WHERE id = ?', [(id_,) for id_, _ in rows])
+                        self._db.execute('COMMIT')
+                    delivered += len(rows)
+
+            if delivered and not len(self):
+                self.compact()
+        return delivered
+
+    def compact(self):
+        """Truncates the write-ahead log and releases unused pages."""
+        with self._lock:
+            self._db.execute('PRAGMA incremental_vacuum')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
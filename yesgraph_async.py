@@ -0,0 +1,399 @@
+"""
+asyncio client for the YesGraph API.
+
+Requires Python 3.5+ and aiohttp (``pip install yesgraph[async]``).
+"""
+import asyncio
+import codecs
+import collections
+import time
+
+import aiohttp
+
+from yesgraph import (DEFAULT_TIMEOUT, AddressBookResult, ChunkedResult, ChunkOutcome, Deadline, DomainEmailsResult,
+                      JSONArrayParser, YesGraphAPI, YesGraphTimeout, is_replayable)
+
+ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, YesGraphTimeout)
+
+
+def timeout_error(error, method, endpoint):
+    """Returns the `YesGraphTimeout` to raise from an aiohttp timeout `error`."""
+    return YesGraphTimeout('{0} {1} timed out: {2!r}'.format(method, endpoint, error))
+
+
+async def aiter_chunks(chunks):
+    """Wraps a regular iterable of body chunks for aiohttp, which only streams async iterables."""
+    for chunk in chunks:
+        yield chunk
+
+
+class AsyncYesGraphAPI(YesGraphAPI):
+    """
+    Non-blocking version of `YesGraphAPI`.
+
+    Exposes exactly the same methods as `YesGraphAPI`, but every method
+    returns a coroutine that has to be awaited. All requests made through a
+    single instance share one keep-alive connection pool, so many calls can
+    be in flight on the same event loop:
+
+        async with AsyncYesGraphAPI(secret_key) as api:
+            books = await asyncio.gather(*[api.get_address_book(u) for u in user_ids])
+    """
+
+    session = None  # the aiohttp session, instead of the lazily created requests one
+
+    def __init__(self, secret_key, base_url='https://api.yesgraph.com/v0/', retry=None, rate_limiter=None,
+                 address_book_cache=None, client_key_cache=None, compress_threshold=None, compress_level=6,
+                 codec=None, address_book_fingerprints=None, event_dedup=None, observers=(), session=None,
+                 limit=100, limit_per_host=0, keepalive_timeout=15, timeout=DEFAULT_TIMEOUT):
+        super(AsyncYesGraphAPI, self).__init__(secret_key, base_url=base_url, retry=retry,
+                                               rate_limiter=rate_limiter, address_book_cache=address_book_cache,
+                                               client_key_cache=client_key_cache,
+                                               compress_threshold=compress_threshold, compress_level=compress_level,
+                                               codec=codec, address_book_fingerprints=address_book_fingerprints,
+                                               event_dedup=event_dedup, observers=observers, timeout=timeout)
+        self._client_key_futures = {}
+        self.session = session
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+
+    def _get_session(self):
+        # The aiohttp session has to be created from within the running event
+        # loop, so it is only built on first use.
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        """Closes the underlying connection pool."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _request(self, method, endpoint, data=None, deadline=None, **url_args):
+        """
+        Builds and sends the complete request to the YesGraph API without
+        blocking the event loop, returning the decoded response. Raises
+        `YesGraphTimeout` when it's not done by `deadline`.
+        """
+        # The trace is started right away, to pick up the encoding time of the body
+        return self._trace_request(self._start_trace(method, endpoint), method, endpoint, data,
+                                   Deadline.get(deadline), **url_args)
+
+    async def _trace_request(self, trace, method, endpoint, data=None, deadline=None, **url_args):
+        try:
+            response = await self._send(method, endpoint, data=data, trace=trace, deadline=deadline, **url_args)
+            async with response:
+                try:
+                    if trace is None:
+                        return await self._handle_response(response)
+                    trace.status = response.status
+                    trace.mark('send')
+                    body = await response.read()
+                    trace.response_bytes = len(body)
+                    trace.mark('read')
+                except asyncio.TimeoutError as e:
+                    raise timeout_error(e, method, endpoint) from e
+                result = await self._handle_response(response)
+                trace.mark('decode')
+                return result
+        except Exception as e:
+            if trace is not None:
+                trace.error = e
+            raise
+        finally:
+            if trace is not None:
+                self._notify(trace)
+
+    async def _send(self, method, endpoint, data=None, trace=None, deadline=None, **url_args):
+        """
+        Sends the request with the timeouts of `self.timeout`, throttled by
+        `self.rate_limiter` and retried according to `self.retry`, all
+        within `deadline`, and returns the (unread) response.
+        """
+        url = self._build_url(endpoint, **url_args)
+        headers = self._build_headers()
+        data = self._compress_body(data, headers)
+
+        retry = self.retry
+        if not is_replayable(data):
+            data = aiter_chunks(data)
+            retry = None
+        if trace is not None:
+            if data is None or isinstance(data, bytes):
+                trace.request_bytes = len(data or b'')
+            trace.mark('prepare')
+
+        session = self._get_session()
+        started = time.time()
+        retries = 0
+        delay = None
+        while True:
+            wait = self._throttle(method, endpoint, deadline)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                response = await session.request(method, url, data=data, headers=headers,
+                                                 timeout=self._client_timeout(endpoint, deadline))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self._retry_delay(retry, method, retries, started, delay, deadline,
+                                          connect_error=isinstance(e, aiohttp.ClientConnectorError))
+                if delay is None:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise timeout_error(e, method, endpoint) from e
+                    raise
+            else:
+                delay = self._retry_delay(retry, method, retries, started, delay, deadline,
+                                          status=response.status, headers=response.headers)
+                if delay is None:
+                    return response
+                response.release()
+
+            retries += 1
+            if trace is not None:
+                trace.retries = retries
+            await asyncio.sleep(delay)
+
+    def _client_timeout(self, endpoint, deadline=None):
+        timeout = self.timeout.for_endpoint(endpoint, deadline)
+        connect, read = timeout or (None, None)
+        # Unlike requests, aiohttp can limit the total time, so the deadline is kept to exactly
+        return aiohttp.ClientTimeout(total=deadline.remaining() if deadline is not None else None,
+                                     sock_connect=connect, sock_read=read)
+
+    async def _handle_response(self, response):
+        """Decodes the HTTP response when successful, or throws an error."""
+        response.raise_for_status()
+        return self.codec.loads(await response.read())
+
+    async def _iter_items(self, key, method, endpoint, chunk_size=16 * 1024, deadline=None, **url_args):
+        deadline = Deadline.get(deadline)
+        trace = self._start_trace(method, endpoint)
+        try:
+            response = await self._send(method, endpoint, trace=trace, deadline=deadline, **url_args)
+            async with response:
+                if trace is not None:
+                    trace.status = response.status
+                    trace.response_bytes = 0
+                    trace.mark('send')
+                response.raise_for_status()
+                parser = JSONArrayParser(key)
+                decoder = codecs.getincrementaldecoder('utf-8')()
+                try:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        if trace is not None:
+                            trace.response_bytes += len(chunk)
+                        for item in parser.feed(decoder.decode(chunk)):
+                            yield item
+                except asyncio.TimeoutError as e:
+                    raise timeout_error(e, method, endpoint) from e
+                parser.feed(decoder.decode(b'', final=True))
+                parser.close()
+                if trace is not None:
+                    trace.mark('read')  # and decode, which is interleaved
+        except Exception as e:
+            if trace is not None:
+                trace.error = e
+            raise
+        finally:
+            if trace is not None:
+                self._notify(trace)
+
+    async def _cached_get(self, cache, user_id, endpoint, deadline=None, **url_args):
+        key = self._build_url(endpoint, **url_args)
+        result = cache.get(user_id, key)
+        if result is None:
+            result = await self._request('GET', endpoint, deadline=deadline, **url_args)
+            cache.set(user_id, key, result)
+        return result
+
+    async def _result(self, value):
+        return super(AsyncYesGraphAPI, self)._result(value)
+
+    async def _events_reported(self, endpoint, entries, result):
+        return super(AsyncYesGraphAPI, self)._events_reported(endpoint, entries, await result)
+
+    async def _address_book_changed(self, user_id, result, fingerprint=None):
+        return super(AsyncYesGraphAPI, self)._address_book_changed(user_id, await result, fingerprint)
+
+    async def _post_chunks(self, endpoint, chunks, concurrency=1, deadline=None):
+        deadline = Deadline.get(deadline)
+
+        async def send(chunk):
+            index, entries, body = chunk
+            try:
+                response = await self._request('POST', endpoint, data=body, deadline=deadline)
+                result.add(ChunkOutcome(index, len(entries), entries, response, None))
+            except ERRORS as e:
+                result.add(ChunkOutcome(index, len(entries), entries, None, e))
+
+        # Only keep `concurrency` chunks encoded and in flight at any time
+        result = ChunkedResult()
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()  # propagates unexpected errors
+            pending.add(asyncio.ensure_future(send(chunk)))
+        for task in pending:
+            await task
+
+        result.sort()
+        return result
+
+    async def get_address_books(self, user_ids, concurrency=10, deadline=None, **filters):
+        """
+        Fetches the address books of many users, `concurrency` at a time.
+        Takes the same filters as `get_address_book()`.
+
+        Asynchronously yields an `AddressBookResult(user_id, result, error)`
+        per user in the order the requests complete. A failing request does
+        not abort the others; its exception is reported in `error` instead.
+        `deadline` applies to all requests together.
+        """
+        deadline = Deadline.get(deadline)
+
+        async def fetch(user_id):
+            try:
+                return AddressBookResult(user_id, await self.get_address_book(user_id, deadline=deadline, **filters),
+                                         None)
+            except ERRORS as e:
+                return AddressBookResult(user_id, None, e)
+
+        pending = set()
+        for user_id in user_ids:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(fetch(user_id)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def iter_domain_emails(self, domain, batch_size=100, prefetch=2, start_page=1, deadline=None):
+        """
+        Asynchronously yields all emails of `domain`, walking through the
+        pages of `get_domain_emails()` until a page comes back short or empty.
+
+        While the caller works through a page, the next `prefetch` pages are
+        already being fetched. `deadline` applies to all pages together.
+        """
+        deadline = Deadline.get(deadline)
+
+        async def fetch(page):
+            response = await self.get_domain_emails(domain, page=page, batch_size=batch_size, deadline=deadline)
+            return response.get('data') or []
+
+        def is_last(emails):
+            return not emails or (batch_size is not None and len(emails) < batch_size)
+
+        pending = collections.deque(asyncio.ensure_future(fetch(page))
+                                    for page in range(start_page, start_page + prefetch + 1))
+        page = start_page + prefetch + 1
+        try:
+            while True:
+                emails = await pending.popleft()
+                for email in emails:
+                    yield email
+                if is_last(emails):
+                    return
+                pending.append(asyncio.ensure_future(fetch(page)))
+                page += 1
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_domains_emails(self, domains, batch_size=100, concurrency=10, deadline=None):
+        """
+        Fetches all emails of many domains, crawling `concurrency` domains
+        at a time.
+
+        Asynchronously yields a `DomainEmailsResult(domain, emails, error)`
+        per domain in the order the domains complete. A failing domain does
+        not abort the others; its exception is reported in `error` instead.
+        `deadline` applies to all domains together.
+        """
+        deadline = Deadline.get(deadline)
+
+        async def crawl(domain):
+            try:
+                emails = [email async for email in self.iter_domain_emails(domain, batch_size, prefetch=0,
+                                                                           deadline=deadline)]
+                return DomainEmailsResult(domain, emails, None)
+            except ERRORS as e:
+                return DomainEmailsResult(domain, None, e)
+
+        pending = set()
+        for domain in domains:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(crawl(domain)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def get_client_key(self, user_id, deadline=None):
+        """
+        Wrapped method for POST of /client-key endpoint
+
+        Documentation - https://docs.yesgraph.com/docs/create-client-keys
+        """
+        if self.client_key_cache is None:
+            result = await self._get_client_key(user_id, deadline)
+            return result['client_key']
+
+        user_id = str(user_id)
+        client_key = self.client_key_cache.get(user_id, 'client_key')
+        if client_key is not None:
+            return client_key
+
+        # Concurrent calls for the same user wait for the same request, with the deadline of the first one
+        future = self._client_key_futures.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._mint_client_key(user_id, deadline))
+            self._client_key_futures[user_id] = future
+            future.add_done_callback(lambda _: self._client_key_futures.pop(user_id, None))
+        return await asyncio.shield(future)
+
+    async def _mint_client_key(self, user_id, deadline=None):
+        result = await self._get_client_key(user_id, deadline)
+        self.client_key_cache.set(user_id, 'client_key', result['client_key'])
+        return result['client_key']
+
+    async def prewarm_client_keys(self, user_ids, concurrency=10, deadline=None):
+        """
+        Fills the client key cache for all `user_ids`, `concurrency` at a
+        time. Returns a dict with the error for every user whose key could
+        not be created.
+        """
+        if self.client_key_cache is None:
+            raise ValueError('Prewarming client keys requires a client_key_cache')
+
+        deadline = Deadline.get(deadline)
+        errors = {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def warm(user_id):
+            async with semaphore:
+                try:
+                    await self.get_client_key(user_id, deadline)
+                except ERRORS as e:
+                    errors[str(user_id)] = e
+
+        await asyncio.gather(*[warm(user_id) for user_id in user_ids])
+        return errors
@@ -0,0 +1,303 @@
+"""
+Local mock of the YesGraph API, for tests and load tests without network.
+
+Speaks the endpoints `YesGraphAPI` uses and can inject latency, errors and
+rate limiting. Run it in-process:
+
+    with MockServer(latency='lognormal:0.05,0.5', error_rate=0.01) as server:
+        api = YesGraphAPI('secret', base_url=server.base_url)
+
+or as a separate process:
+
+    $ python -m yesgraph_mock --port 8000 --latency uniform:0.01,0.1 --throttle-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+
+
+def parse_latency(spec, rng=random):
+    """
+    Returns a function returning a latency in seconds, from a number of
+    seconds, a callable, or a distribution spec: 'fixed:S', 'uniform:A,B',
+    'exponential:MEAN' or 'lognormal:MEDIAN,SIGMA'. Random latencies are
+    drawn from `rng`.
+    """
+    if spec is None:
+        return lambda: 0.0
+    if callable(spec):
+        return spec
+    if isinstance(spec, (int, float)):
+        return lambda: float(spec)
+
+    name, _, args = spec.partition(':')
+    args = [float(arg) for arg in args.split(',') if arg]
+    if name == 'fixed':
+        return lambda: args[0]
+    if name == 'uniform':
+        return lambda: rng.uniform(args[0], args[1])
+    if name == 'exponential':
+        return lambda: rng.expovariate(1.0 / args[0])
+    if name == 'lognormal':
+        return lambda: rng.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError('Unknown latency distribution: {0}'.format(spec))
+
+
+def make_contacts(n, offset=0):
+    return [{'name': 'Contact {0}'.format(i), 'emails': ['contact{0}@example.org'.format(i)]}
+            for i in range(offset, offset + n)]
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+
+    routes = [
+        ('GET', re.compile(r'^/test$'), 'test'),
+        ('POST', re.compile(r'^/client-key$'), 'client_key'),
+        ('POST', re.compile(r'^/address-book$'), 'post_address_book'),
+        ('GET', re.compile(r'^/address-book/(?P<user_id>[^/]+)$'), 'get_address_book'),
+        ('DELETE', re.compile(r'^/address-book/(?P<user_id>[^/]+)$'), 'delete_address_book'),
+        ('POST', re.compile(r'^/(?P<kind>invites-sent|invites-accepted|suggested-seen|alias|users)$'), 'post_batch'),
+        ('GET', re.compile(r'^/domain-emails/(?P<domain>[^/]+)$'), 'domain_emails'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+                if not length:
+                    break
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def send(self, status, doc=None, body=None, headers=()):
+        if body is None:
+            body = json.dumps(doc).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status)
+
+    def handle_any(self):
+        server = self.server
+        body = self.read_body()
+        url = urlparse(self.path)
+        path = url.path[len(server.prefix):] if url.path.startswith(server.prefix) else url.path
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+
+        delay = server.latency()
+        if delay > 0:
+            time.sleep(delay)
+
+        retry_after = server.throttle()
+        if retry_after is not None:
+            return self.send(429, {'error': 'Too many requests'}, headers=[('Retry-After', str(retry_after))])
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self.send(server.error_status, {'error': 'Injected error'})
+
+        for method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if match and method == self.command:
+                try:
+                    doc = json.loads(body.decode('utf-8')) if body else None
+                except ValueError:
+                    return self.send(400, {'error': 'Invalid JSON'})
+                return getattr(self, name)(doc, query, **dict((k, unquote(v)) for k, v in match.groupdict().items()))
+        return self.send(404, {'error': 'Not found'})
+
+    do_GET = do_POST = do_DELETE = handle_any
+
+    def test(self, doc, query):
+        self.send(200, {'message': 'ok'})
+
+    def client_key(self, doc, query):
+        user_id = str((doc or {}).get('user_id', ''))
+        self.send(200, {'user_id': user_id, 'client_key': hashlib.sha1(user_id.encode('utf-8')).hexdigest()})
+
+    def post_address_book(self, doc, query):
+        if not doc or 'user_id' not in doc or not isinstance(doc.get('entries'), list):
+            return self.send(400, {'error': 'user_id and entries are required'})
+        entries = doc['entries']
+        if self.server.store:
+            with self.server.lock:
+                self.server.address_books[str(doc['user_id'])] = entries
+        self.send(200, {'meta': {'total': len(entries)}, 'data': entries[:doc.get('limit') or 20]})
+
+    def get_address_book(self, doc, query, user_id):
+        limit = int(query.get('limit', 20))
+        with self.server.lock:
+            entries = self.server.address_books.get(user_id)
+        if entries is not None:
+            return self.send(200, {'meta': {'total': len(entries)}, 'data': entries[:limit]})
+
+        # Users without an uploaded address book get a generated one
+        body = self.server.generated.get(limit)
+        if body is None:
+            body = self.server.generated[limit] = json.dumps({
+                'meta': {'total': limit}, 'data': make_contacts(limit)}).encode('utf-8')
+        self.send(200, body=body)
+
+    def delete_address_book(self, doc, query, user_id):
+        with self.server.lock:
+            self.server.address_books.pop(user_id, None)
+        self.send(200, {'message': 'Address book deleted'})
+
+    def post_batch(self, doc, query, kind):
+        entries = doc if kind == 'users' and isinstance(doc, list) else (doc or {}).get(
+            'emails' if kind == 'alias' else 'entries')
+        if not isinstance(entries, list):
+            return self.send(400, {'error': 'An entry list is required'})
+        self.send(200, {'message': 'ok', 'count': len(entries)})
+
+    def domain_emails(self, doc, query, domain):
+        page = int(query.get('page', 1))
+        batch_size = int(query.get('batch_size', 100))
+        start = (page - 1) * batch_size
+        stop = min(start + batch_size, self.server.domain_size)
+        emails = ['user{0}@{1}'.format(i, domain) for i in range(start, stop)]
+        self.send(200, {'meta': {'page': page, 'batch_size': batch_size, 'total': self.server.domain_size},
+                        'data': emails})
+
+
+class MockServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded mock YesGraph API server.
+
+    - `latency`: seconds, a callable or a spec for `parse_latency()`,
+      added to every request
+    - `error_rate`: fraction of requests answered with `error_status`
+    - `throttle_rate`: fraction of requests answered with a 429 and a
+      `retry_after` seconds Retry-After header
+    - `rate_limit`: requests per second above which requests get a 429,
+      with a Retry-After until the next second
+    - `domain_size`: number of emails per domain, for pagination
+    - `store`: keep posted address books for `get_address_book()`;
+      other users get a generated one of `limit` contacts
+
+    `stats` counts the responses sent per status code.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_rate=0.0, error_status=500,
+                 throttle_rate=0.0, retry_after=1, rate_limit=None, domain_size=250, store=True, seed=None,
+                 prefix='/v0'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockHandler)
+        self.random = random.Random(seed)
+        self.latency = parse_latency(latency, self.random)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.domain_size = domain_size
+        self.store = store
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.address_books = {}
+        self.generated = {}
+        self.stats = {}
+        self._window = (0, 0)  # (second, requests in it)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}{2}/'.format(self.server_address[0], self.server_address[1], self.prefix)
+
+    def throttle(self):
+        """Returns the Retry-After for a request that's throttled, or None."""
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            return self.retry_after
+        if self.rate_limit is not None:
+            now = time.time()
+            with self.lock:
+                second, count = self._window
+                if int(now) != second:
+                    second, count = int(now), 0
+                self._window = (second, count + 1)
+            if count >= self.rate_limit:
+                return max(1, int(math.ceil(second + 1 - now)))
+        return None
+
+    def count(self, status):
+        with self.lock:
+            self.stats[status] = self.stats.get(status, 0) + 1
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock YesGraph API server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', help="e.g. 0.05, 'uniform:0.01,0.1' or 'lognormal:0.05,0.5'")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--rate-limit', type=float)
+    parser.add_argument('--domain-size', type=int, default=250)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-store', action='store_true', help='answer every GET /address-book with a '
+                        'generated address book')
+    args = parser.parse_args()
+
+    latency = args.latency
+    if latency is not None and ':' not in latency:
+        latency = float(latency)
+    server = MockServer(args.host, args.port, latency=latency, error_rate=args.error_rate,
+                        error_status=args.error_status, throttle_rate=args.throttle_rate,
+                        retry_after=args.retry_after, rate_limit=args.rate_limit, domain_size=args.domain_size,
+                        store=not args.no_store, seed=args.seed)
+    print('Serving the mock YesGraph API at {0}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()